@@ -0,0 +1,143 @@
+import datetime
+import fnmatch
+import os
+import re
+import sqlite3
+import time
+
+
+# Date patterns tried (in order) on file names, i.e. nt_20180101_f18_nrt_n.bin, ncep_2018_01.grib
+DATE_PATTERNS = [(re.compile(r'(?<!\d)(\d{4})-?(\d{2})-?(\d{2})(?!\d)'), '%Y%m%d'),
+                 (re.compile(r'(?<!\d)(\d{4})[_-](\d{2})(?!\d)'), '%Y%m')]
+
+
+def guess_file_date(fname):
+    ''' Return the first date (as YYYY-MM-DD string) found in a file name, or None.'''
+    for (pattern, fmt) in DATE_PATTERNS:
+        for m in pattern.finditer(os.path.basename(fname)):
+            try:
+                return datetime.datetime.strptime(''.join(m.groups()), fmt).strftime('%Y-%m-%d')
+            except ValueError:
+                continue # i.e. 2018_13 is not a date
+    return None
+
+
+class FileCatalog(object):
+    """ Persistent (SQLite) catalog of data files and of which processing stages have used them.
+
+    Files are added/updated by scan() (only directory listings and stats, no file is opened).
+    A stage asks pending(stage) for files it has not processed yet (or that changed since),
+    and calls mark(paths, stage) once done.
+    """
+
+    def __init__(self, db_file=None):
+        """"""
+        self.db_file = db_file
+        self.con = sqlite3.connect(db_file)
+        with self.con:
+            self.con.execute('''CREATE TABLE IF NOT EXISTS files (
+                                path TEXT PRIMARY KEY, dir TEXT, name TEXT, source TEXT, kind TEXT,
+                                size INTEGER, mtime REAL, date TEXT, first_seen REAL, removed INTEGER DEFAULT 0)''')
+            self.con.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS files_source ON files (source, kind, date)')
+            self.con.execute('''CREATE TABLE IF NOT EXISTS status (
+                                path TEXT, stage TEXT, status TEXT, updated REAL,
+                                PRIMARY KEY (path, stage))''')
+
+    def close(self):
+        self.con.close()
+
+    def scan(self, directory=None, pattern='*', source=None, kind=None, date_parser=guess_file_date,
+             recursive=False):
+        """ Incrementally scan one directory. Returns list of paths that are new or changed.
+        source is the model or product name (i.e. NSIDC_0081, ncep), kind the sub dir (native, sipn_nc).
+        recursive also scans sub dirs (i.e. the <metric>/<init>/<model> tree of MME sipn_nc)."""
+        directory = os.path.abspath(directory)
+        known = {r[0]: (r[1], r[2]) for r in
+                 self.con.execute('SELECT name, size, mtime FROM files WHERE dir=? AND removed=0', (directory,))}
+
+        now = time.time()
+        found = set()
+        changed = []
+        rows = []
+        sub_dirs = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if recursive and entry.is_dir():
+                    sub_dirs.append(entry.path)
+                    continue
+                if not fnmatch.fnmatch(entry.name, pattern):
+                    continue
+                st = entry.stat()
+                found.add(entry.name)
+                if known.get(entry.name) == (st.st_size, st.st_mtime):
+                    continue # Unchanged
+                changed.append(entry.path)
+                rows.append((entry.path, directory, entry.name, source, kind, st.st_size, st.st_mtime,
+                             date_parser(entry.name) if date_parser else None, now))
+        gone = [(os.path.join(directory, x),) for x in known if (x not in found) & fnmatch.fnmatch(x, pattern)]
+
+        with self.con:
+            self.con.executemany('''INSERT INTO files (path, dir, name, source, kind, size, mtime, date, first_seen)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT(path) DO UPDATE SET size=excluded.size, mtime=excluded.mtime,
+                                    source=excluded.source, kind=excluded.kind, date=excluded.date, removed=0''', rows)
+            self.con.executemany('UPDATE files SET removed=1 WHERE path=?', gone)
+
+        for c_dir in sub_dirs:
+            changed = changed + self.scan(c_dir, pattern=pattern, source=source, kind=kind,
+                                          date_parser=date_parser, recursive=True)
+        return sorted(changed)
+
+    def files(self, source=None, kind=None, start=None, end=None):
+        """ Sorted paths of (not removed) files, optionally by source, kind and date range (YYYY-MM-DD)."""
+        (where, args) = self._where(source=source, kind=kind, start=start, end=end)
+        return [r[0] for r in self.con.execute('SELECT path FROM files f WHERE '+where+' ORDER BY path', args)]
+
+    def pending(self, stage=None, source=None, kind=None, start=None, end=None):
+        """ Sorted paths a stage has not processed yet, or that changed since it did."""
+        (where, args) = self._where(source=source, kind=kind, start=start, end=end)
+        sql = ('SELECT f.path FROM files f LEFT JOIN status s ON s.path=f.path AND s.stage=? WHERE '+where+
+               " AND (s.status IS NULL OR s.status!='done' OR s.updated < f.mtime) ORDER BY f.path")
+        return [r[0] for r in self.con.execute(sql, [stage] + args)]
+
+    def mark(self, paths, stage=None, status='done'):
+        """ Record the processing status (i.e. done, failed) of files by a stage."""
+        if isinstance(paths, str):
+            paths = [paths]
+        now = time.time()
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO status (path, stage, status, updated) VALUES (?, ?, ?, ?)',
+                                 [(os.path.abspath(p), stage, status, now) for p in paths])
+
+    def _where(self, source=None, kind=None, start=None, end=None):
+        where = ['f.removed=0']
+        args = []
+        for (col, op, val) in [('source', '=', source), ('kind', '=', kind), ('date', '>=', start), ('date', '<=', end)]:
+            if val is not None:
+                where.append('f.'+col+op+'?')
+                args.append(str(val))
+        return (' AND '.join(where), args)
+
+
+def get_catalog(E=None, filename='esio_catalog.sqlite'):
+    ''' Open the file catalog stored in the data_dir of an EsioData object.'''
+    return FileCatalog(os.path.join(E.data_dir, filename))
+
+
+def scan_esio(E=None, catalog=None, kinds=['native', 'sipn_nc']):
+    ''' Incrementally scan the native and sipn_nc dirs of all obs and models of an EsioData object.
+    Returns dict of source -> list of new or changed files.'''
+    if catalog is None:
+        catalog = get_catalog(E)
+    new = {}
+    dirs = [(c_obs, k, E.obs[c_obs][k]) for c_obs in E.obs for k in kinds if k in E.obs[c_obs]]
+    for c_mod in E.model:
+        for run_type in ['forecast', 'reanalysis', 'reforecast']:
+            # kind of model files is i.e. forecast/native
+            dirs = dirs + [(c_mod, run_type+'/'+k, E.model[c_mod][run_type][k])
+                           for k in kinds if k in E.model[c_mod].get(run_type, {})]
+    for (source, kind, cdir) in dirs:
+        if os.path.isdir(cdir):
+            new.setdefault(source, []).extend(catalog.scan(cdir, source=source, kind=kind))
+    return new
@@ -0,0 +1,182 @@
+import json
+import os
+import tempfile
+
+import dask
+import dask.array as dsa
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# Sea ice concentration in GRIB files of the S2S/YOPP models (ECMWF ci, NCEP icec, CMIP style siconc)
+SIC_SHORT_NAMES = ['ci', 'icec', 'siconc']
+
+# Message keys stored in the index (missing keys are None)
+INDEX_KEYS = ['shortName', 'paramId', 'number', 'endStep', 'dataDate', 'dataTime', 'gridType', 'Ni', 'Nj']
+INDEX_VERSION = 1
+
+
+def _eccodes():
+    ''' Import eccodes (optional dependency, only needed to read GRIB).'''
+    try:
+        import eccodes
+    except ImportError:
+        raise ImportError('Reading GRIB files needs eccodes (pip install eccodes).')
+    return eccodes
+
+
+def _get_key(eccodes, gid, key):
+    try:
+        return eccodes.codes_get(gid, key)
+    except eccodes.KeyValueNotFoundError:
+        return None
+
+
+def build_index(path):
+    ''' Scan the headers of all messages of a GRIB file (values are not decoded).
+    Returns a DataFrame with one row per message: offset, length and INDEX_KEYS.'''
+    eccodes = _eccodes()
+    rows = []
+    with open(path, 'rb') as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                eccodes.codes_set(gid, 'stepUnits', 'h') # endStep in hours
+                row = {'offset': eccodes.codes_get_message_offset(gid), 'length': eccodes.codes_get_message_size(gid)}
+                for key in INDEX_KEYS:
+                    row[key] = _get_key(eccodes, gid, key)
+            finally:
+                eccodes.codes_release(gid)
+            rows.append(row)
+    return pd.DataFrame(rows, columns=['offset', 'length'] + INDEX_KEYS)
+
+
+def get_index_path(path, index_dir=None):
+    ''' Sidecar index of a GRIB file, next to it or in index_dir (i.e. if the data dir is read only).'''
+    if index_dir is None:
+        return path + '.esio.json'
+    return os.path.join(index_dir, os.path.basename(path) + '.esio.json')
+
+
+def get_index(path, index_dir=None):
+    ''' Return the message index of a GRIB file, from its sidecar file if still valid (same size
+    and mtime of the GRIB file), else scanned and saved.'''
+    st = os.stat(path)
+    index_path = get_index_path(path, index_dir=index_dir)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path) as f:
+                saved = json.load(f)
+            if (saved['version'] == INDEX_VERSION) & (saved['size'] == st.st_size) & (saved['mtime'] == st.st_mtime):
+                return pd.DataFrame(saved['messages'], columns=['offset', 'length'] + INDEX_KEYS)
+        except (ValueError, KeyError):
+            pass # Corrupt index, rebuild it
+
+    index = build_index(path)
+    saved = {'version': INDEX_VERSION, 'size': st.st_size, 'mtime': st.st_mtime,
+             'messages': json.loads(index.to_json(orient='records'))}
+    # Write to a temporary file, then move it in place (readers never see a partial index)
+    (fd, tmp_path) = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(index_path) or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(saved, f)
+    os.replace(tmp_path, index_path)
+    return index
+
+
+def read_message(path, offset, length, shape):
+    ''' Decode the values of one message (missing values are NaN) into a float32 array of shape.'''
+    eccodes = _eccodes()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        message = f.read(length)
+    gid = eccodes.codes_new_from_message(message)
+    try:
+        values = eccodes.codes_get_values(gid).astype(np.float32)
+        if _get_key(eccodes, gid, 'bitmapPresent'):
+            values[values == eccodes.codes_get(gid, 'missingValue')] = np.nan
+    finally:
+        eccodes.codes_release(gid)
+    return values.reshape(shape)
+
+
+def read_grid(path, offset, length):
+    ''' lat/lon coords of the grid of one message (1D for regular grids, else 2D on nj, ni).'''
+    eccodes = _eccodes()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        message = f.read(length)
+    gid = eccodes.codes_new_from_message(message)
+    try:
+        grid_type = eccodes.codes_get(gid, 'gridType')
+        if grid_type in ['regular_ll', 'regular_gg']:
+            return {'lat': ('lat', eccodes.codes_get_array(gid, 'distinctLatitudes')),
+                    'lon': ('lon', eccodes.codes_get_array(gid, 'distinctLongitudes'))}
+        shape = (eccodes.codes_get(gid, 'Nj'), eccodes.codes_get(gid, 'Ni'))
+        return {'lat': (('nj', 'ni'), eccodes.codes_get_array(gid, 'latitudes').reshape(shape)),
+                'lon': (('nj', 'ni'), eccodes.codes_get_array(gid, 'longitudes').reshape(shape))}
+    finally:
+        eccodes.codes_release(gid)
+
+
+def open_grib_var(paths, short_names=SIC_SHORT_NAMES, name='sic', index_dir=None):
+    ''' Open one variable (first of short_names found) of GRIB files as a lazy (dask) DataArray
+    on (ensemble, init_time, fore_time, lat, lon). Only the messages of that variable are decoded,
+    each one separately when needed (in parallel by dask), other messages are never read.
+    ----------
+    Parameters:
+    paths : List
+        GRIB files (i.e. all files of one model and init month)
+    short_names : List
+        GRIB shortName of the variable, the first one found is used
+    name : String
+        Name of the output DataArray
+    index_dir : String
+        (optional) Directory of the sidecar indexes (default is next to each file)
+
+    Returns:
+    da = DataArray
+        Variable, NaN for missing member/step combinations
+    '''
+    if isinstance(paths, str):
+        paths = [paths]
+    index = []
+    for path in paths:
+        c_index = get_index(path, index_dir=index_dir)
+        c_index['path'] = path
+        index.append(c_index)
+    index = pd.concat(index, ignore_index=True)
+    found = [x for x in short_names if x in set(index.shortName)]
+    if not found:
+        raise ValueError('None of '+str(short_names)+' found in GRIB files.')
+    index = index[index.shortName == found[0]].copy()
+
+    index['number'] = index['number'].fillna(0).astype(int) # Deterministic runs have no number
+    index['init_time'] = pd.to_datetime(index.dataDate.astype(int).astype(str) +
+                                        index.dataTime.astype(int).map('{:04d}'.format), format='%Y%m%d%H%M')
+    index['fore_time'] = pd.to_timedelta(index.endStep.astype(int), unit='h')
+    if index.duplicated(['number', 'init_time', 'fore_time']).any():
+        raise ValueError('Found duplicate messages of '+found[0])
+
+    first = index.iloc[0]
+    shape = (int(first.Nj), int(first.Ni))
+    coords = read_grid(first.path, int(first.offset), int(first.length))
+    ensemble = np.sort(index.number.unique())
+    init_time = np.sort(index.init_time.unique())
+    fore_time = np.sort(index.fore_time.unique())
+
+    # One delayed decode per message, all NaN where no message
+    missing = dsa.full(shape, np.nan, dtype=np.float32, chunks=shape)
+    fields = {(r.number, r.init_time, r.fore_time): dsa.from_delayed(
+              dask.delayed(read_message)(r.path, int(r.offset), int(r.length), shape), shape, dtype=np.float32)
+              for r in index.itertuples()}
+    data = dsa.stack([dsa.stack([dsa.stack([fields.get((e, pd.Timestamp(i), pd.Timedelta(f)), missing)
+                                            for f in fore_time]) for i in init_time]) for e in ensemble])
+
+    spatial_dims = ('lat', 'lon') if coords['lat'][0] == 'lat' else ('nj', 'ni')
+    da = xr.DataArray(data, dims=('ensemble', 'init_time', 'fore_time') + spatial_dims,
+                      coords=dict(coords, ensemble=ensemble, init_time=init_time, fore_time=fore_time), name=name)
+    da.attrs['grib_shortName'] = found[0]
+    return da
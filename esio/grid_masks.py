@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# Passive microwave sensor eras of the NSIDC records (the pole hole only changes between them)
+# name, first day, last day (None is ongoing)
+SENSOR_ERAS = [('SMMR', '1978-10-25', '1987-08-20'),
+               ('SSMI', '1987-08-21', '2007-12-31'),
+               ('SSMIS', '2008-01-01', None)]
+
+
+def get_sensor_era(times):
+    ''' Return the index (into SENSOR_ERAS) of the sensor era of each time.'''
+    times = pd.to_datetime(np.atleast_1d(times))
+    era_i = np.full(times.size, -1, dtype=int)
+    for (i, (name, start, end)) in enumerate(SENSOR_ERAS):
+        in_era = times >= pd.Timestamp(start)
+        if end:
+            in_era = in_era & (times <= pd.Timestamp(end))
+        era_i[np.asarray(in_era)] = i
+    if (era_i < 0).any():
+        raise ValueError('Found times before the first sensor era.')
+    return era_i
+
+
+def build_hole_mask_table(ds_obs=None):
+    ''' Derive the (era, y, x) pole hole mask table from observations with a daily hole_mask.
+    The mask of an era is the union of all daily masks found in it (eras without data are all False).'''
+    era_i = xr.DataArray(get_sensor_era(ds_obs.time.values), dims='time', coords={'time': ds_obs.time},
+                         name='era_i')
+    hole_era = ds_obs.hole_mask.groupby(era_i).any(dim='time').load()
+    hole_era = hole_era.reindex(era_i=np.arange(len(SENSOR_ERAS)), fill_value=False)
+    hole_era = hole_era.drop_vars([x for x in hole_era.coords if x not in ['x', 'y']])
+
+    table = xr.Dataset({'hole_mask': hole_era.rename({'era_i': 'era'})})
+    table.coords['era'] = [x[0] for x in SENSOR_ERAS]
+    table.coords['era_start'] = ('era', [x[1] for x in SENSOR_ERAS])
+    table.coords['era_end'] = ('era', [x[2] or '' for x in SENSOR_ERAS])
+    return table
+
+
+def get_hole_mask_table_path(E=None):
+    return os.path.join(E.grid_dir, 'NSIDC_hole_mask_eras.nc')
+
+
+def save_hole_mask_table(table, path):
+    table.to_netcdf(path, encoding={'hole_mask': {'zlib': True}})
+
+
+def load_hole_mask_table(path):
+    ''' Load the pole hole table (a few hundred kB) into memory.'''
+    with xr.open_dataset(path) as table:
+        table = table.load()
+    table['hole_mask'] = table.hole_mask.astype(bool)
+    return table
+
+
+def attach_hole_mask(ds, table):
+    ''' Add the hole_mask coordinate of each time of ds from the era table, lazily (dask)
+    so no per-day grid is built until (a part of) it is used.'''
+    era_i = xr.DataArray(get_sensor_era(ds.time.values), dims='time', coords={'time': ds.time})
+    hole_mask = table.hole_mask.chunk({'era': 1}).isel(era=era_i)
+    ds.coords['hole_mask'] = hole_mask.drop_vars([x for x in hole_mask.coords if x not in ['time', 'x', 'y']])
+    return ds
+
+
+SURFACE_TYPES = ['coast', 'land', 'missing']
+
+
+def build_surface_masks(all_files=None, product=None):
+    ''' Extract the static coast, land and missing masks (y, x) of a NSIDC product from native files.
+    coast and land are flagged if found on any day, missing only if missing on every day
+    (so swath gaps of single days are not included).'''
+    from . import import_data
+    info = import_data.get_NSIDC_product(product)
+    raw = import_data.open_NSIDC_batch(all_files, product=product, decode=False).sic
+    masks = xr.Dataset({'coast': (raw == info['coast']).any(dim='time'),
+                        'land': (raw == info['land']).any(dim='time'),
+                        'missing': (raw == info['missing']).all(dim='time')}).load()
+    masks.attrs['product'] = product
+    return masks
+
+
+def get_surface_masks_path(E=None, product=None):
+    return os.path.join(E.grid_dir, product+'_surface_masks.nc')
+
+
+def save_surface_masks(masks, path):
+    masks.to_netcdf(path, encoding={x: {'zlib': True} for x in masks.data_vars})
+
+
+def load_surface_masks(path):
+    with xr.open_dataset(path) as masks:
+        masks = masks.load()
+    return masks.astype(bool)
+
+
+def attach_surface_masks(ds, masks, names=SURFACE_TYPES):
+    ''' Add the static (y, x) surface type masks as coords of ds (no time dim, so no per-day cost).'''
+    for cname in names:
+        ds.coords[cname] = masks[cname].drop_vars([x for x in masks[cname].coords if x not in ['x', 'y']])
+    return ds
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+from . import import_data
+from . import regrid
+
+
+EARTH_RADIUS = 6371. # km
+
+_grids = {} # key -> grid Dataset, so each grid is only built once per process
+
+
+def _file_key(paths, *args):
+    ''' Key of grid files: absolute path, mtime and size of each, plus extra args (i.e. model).'''
+    key = []
+    for path in paths:
+        st = os.stat(path)
+        key.append((os.path.abspath(path), st.st_mtime, st.st_size))
+    return tuple(key) + args
+
+
+def _cache_path(cache_dir, key, name):
+    return os.path.join(cache_dir, name+'_'+hashlib.sha1(str(key).encode()).hexdigest()[:16]+'.nc')
+
+
+def _get_or_build(key, name, build, cache_dir=None):
+    ''' Return the grid of key from memory, else from cache_dir (if given), else build() it (and save it).
+    A shallow copy is returned, so callers adding or replacing variables do not change the cached grid.'''
+    if key not in _grids:
+        path = _cache_path(cache_dir, key, name) if cache_dir else None
+        if path and os.path.exists(path):
+            with xr.open_dataset(path) as ds:
+                ds = ds.load()
+            for cvar in ['imask', 'mask']:
+                if cvar in ds:
+                    ds[cvar] = ds[cvar].astype(bool)
+        else:
+            ds = build()
+            if path:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                # Unique temporary file, then move it in place (processes building the same grid never mix files)
+                (fd, tmp_path) = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+                os.close(fd)
+                ds.to_netcdf(tmp_path)
+                os.replace(tmp_path, path)
+        _grids[key] = ds
+    return _grids[key].copy()
+
+
+def clear():
+    ''' Drop all grids held in memory.'''
+    _grids.clear()
+
+
+def cell_areas(lat_b=None, lon_b=None, radius=EARTH_RADIUS):
+    ''' Area (km^2 for the default radius) of each cell from its (nj+1, ni+1) corners, as the sum
+    of the two spherical triangles of the cell.'''
+    lat_b = np.asarray(lat_b)
+    lon_b = np.asarray(lon_b)
+    shape = (lat_b.shape[0] - 1, lat_b.shape[1] - 1)
+    xyz = regrid.lat_lon_to_xyz(lat_b, lon_b).reshape(lat_b.shape + (3,))
+    (a, b, c, d) = (xyz[:-1, :-1], xyz[:-1, 1:], xyz[1:, 1:], xyz[1:, :-1])
+
+    def triangle(p, q, r):
+        # Van Oosterom and Strackee, solid angle of a spherical triangle
+        numer = np.abs(np.einsum('...i,...i', p, np.cross(q, r)))
+        denom = 1. + np.einsum('...i,...i', p, q) + np.einsum('...i,...i', q, r) + np.einsum('...i,...i', r, p)
+        return 2. * np.arctan2(numer, denom)
+    return ((triangle(a, b, c) + triangle(a, c, d)) * radius**2).reshape(shape)
+
+
+def _add_area(ds):
+    if ('lat_b' in ds) and ('lon_b' in ds):
+        ds['area'] = (ds.lat.dims, cell_areas(ds.lat_b.values, ds.lon_b.values))
+        ds['area'].attrs['units'] = 'km^2'
+    return ds
+
+
+def get_grid_info(grid_file=None, model=None, cache_dir=None):
+    ''' Cached import_data.load_grid_info (SCRIP gridinfo file to centers, corners and imask),
+    plus cell area. Built once per process (and once in cache_dir if given) per file version.'''
+    def build():
+        return _add_area(import_data.load_grid_info(grid_file, model=model).load())
+    return _get_or_build(_file_key([grid_file], model), 'gridinfo_'+str(model), build, cache_dir=cache_dir)
+
+
+def get_stero_N_grid(grid_dir=None, cache_dir=None):
+    ''' Cached import_data.get_stero_N_grid (lat/lon of the NSIDC 25 km grid from the psn25 binaries).'''
+    files = [os.path.join(grid_dir, 'psn25lats_v3.dat'), os.path.join(grid_dir, 'psn25lons_v3.dat')]
+    return _get_or_build(_file_key(files), 'psn25', lambda: import_data.get_stero_N_grid(grid_dir),
+                         cache_dir=cache_dir)
+
+
+def get_cell_bounds(ds, cache_dir=None):
+    ''' Cell corners (lat_b, lon_b on nj_b, ni_b) of a curvilinear grid with only centers (i.e. RASM),
+    bilinearly interpolated (and extrapolated at the edges) half a cell from the centers, as
+    ds.interp(nj=nj_b-0.5, ni=ni_b-0.5) did in Regrid_RASM. Cached by grid hash,
+    so files on the same grid reuse them.'''
+    def build():
+        bounds = {}
+        for cvar in ['lat', 'lon']:
+            # Linear extrapolation by one cell on each side, then mean of the 4 centers around each corner
+            p = np.pad(np.asarray(ds[cvar].values, dtype=np.float64), 1, mode='reflect', reflect_type='odd')
+            bounds[cvar+'_b'] = (('nj_b', 'ni_b'), (p[:-1, :-1] + p[1:, :-1] + p[:-1, 1:] + p[1:, 1:]) / 4.)
+        return xr.Dataset(bounds)
+    key = ('bounds', regrid.grid_hash(ds, varnames=('lat', 'lon')))
+    return _get_or_build(key, 'bounds', build, cache_dir=cache_dir)
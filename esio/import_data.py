@@ -2,6 +2,7 @@ import datetime
 import os
 import glob
 import re
+import warnings
 import numpy as np
 import pandas as pd
 import scipy
@@ -194,12 +195,16 @@ def get_stero_N_grid(grid_dir):
     return xr.Dataset({'lat': (['x', 'y'],  lat), 'lon': (['x', 'y'], lon)})
 
 def naive_fast(latvar,lonvar,lat0,lon0):
-    # Read latitude and longitude from file into numpy arrays
-    latvals = latvar[:]
-    lonvals = lonvar[:]
-    dist_sq = (latvals-lat0)**2 + (lonvals-lon0)**2
-    minindex_flattened = dist_sq.argmin()  # 1D index of min element
-    iy_min,ix_min = np.unravel_index(minindex_flattened, latvals.shape)
+    ''' Return the (iy, ix) indices of the grid cell nearest to lat0/lon0 (scalars or arrays).
+    Uses a KD-tree on the sphere (correct at the pole and dateline), built once per grid.'''
+    from . import regrid
+    latvals = np.asarray(latvar[:])
+    lonvals = np.asarray(lonvar[:])
+    ds_grid = xr.Dataset({'lat': (('nj', 'ni'), latvals), 'lon': (('nj', 'ni'), lonvals)})
+    (index, dist) = regrid.get_nearest_index(ds_grid).query(lat0, lon0)
+    if np.ndim(lat0) == 0:
+        index = index[0]
+    iy_min,ix_min = np.unravel_index(index, latvals.shape)
     return iy_min,ix_min
 
 
@@ -256,11 +261,16 @@ def cell_bounds_to_corners_GFDL(gridinfo=None, varname=None):
 
 
 def add_matrix_NaNs(regridder):
-    X = regridder.A
-    M = scipy.sparse.csr_matrix(X)
-    num_nonzeros = np.diff(M.indptr)
-    M[num_nonzeros == 0, 0] = np.NaN
-    regridder.A = scipy.sparse.coo_matrix(M)
+    ''' Put a NaN weight in the empty rows of a xesmf regridder (so cells outside the source are NaN).
+    New code should use regrid.Regridder, which flags empty rows without editing the weights.'''
+    X = scipy.sparse.coo_matrix(regridder.A)
+    num_nonzeros = np.bincount(X.row, minlength=X.shape[0])
+    nan_rows = np.flatnonzero(num_nonzeros == 0)
+    # Append entries in COO form (assigning into a CSR matrix changes its structure, which is slow)
+    regridder.A = scipy.sparse.coo_matrix((np.concatenate([X.data, np.full(nan_rows.size, np.nan)]),
+                                           (np.concatenate([X.row, nan_rows]),
+                                            np.concatenate([X.col, np.zeros(nan_rows.size, dtype=X.col.dtype)]))),
+                                          shape=X.shape)
     return regridder
 
 
@@ -390,6 +400,64 @@ def expand_to_sipn_dims(ds):
     return ds
 
 
+# On-disk packing of regridded (sipn_nc) variables in uint16 mode: values are clipped to valid_range
+# and stored with scale_factor/add_offset (65535 is the _FillValue), other variables are float32
+SIPN_NC_PACKING = {'sic': {'valid_range': (0., 1.)},
+                   'hi': {'valid_range': (0., 20.)}} # m, 20 m / 65534 = 0.3 mm resolution
+
+
+def get_sipn_nc_encoding(ds, mode='float32', chunk_bytes=4*1024**2, complevel=1):
+    ''' netcdf encoding of regridded variables: float32 (mode='float32') or scaled uint16 (mode='uint16',
+    see SIPN_NC_PACKING) with zlib and shuffle. Chunks hold whole maps (all y, x) of one ensemble and
+    init_time and as many fore_times as fit in chunk_bytes (maps and time series of a member are read).'''
+    if mode not in ['float32', 'uint16']:
+        raise ValueError('mode must be float32 or uint16, got '+str(mode))
+    encoding = {}
+    for cvar in ds.data_vars:
+        da = ds[cvar]
+        if not np.issubdtype(da.dtype, np.floating):
+            continue
+        c_enc = {'zlib': True, 'shuffle': True, 'complevel': complevel, 'dtype': 'float32', '_FillValue': np.nan}
+        if (mode == 'uint16') and (cvar in SIPN_NC_PACKING):
+            (vmin, vmax) = SIPN_NC_PACKING[cvar]['valid_range']
+            c_enc.update({'dtype': 'uint16', 'scale_factor': (vmax - vmin) / 65534., 'add_offset': vmin,
+                          '_FillValue': 65535})
+        map_size = int(np.prod([da.sizes[d] for d in da.dims if d not in ['ensemble', 'init_time', 'fore_time']]))
+        n_map = max(1, int(chunk_bytes // (map_size * np.dtype(c_enc['dtype']).itemsize)))
+        c_enc['chunksizes'] = tuple(min(da.sizes[d], n_map) if d == 'fore_time' else
+                                    (1 if d in ['ensemble', 'init_time'] else da.sizes[d]) for d in da.dims)
+        encoding[cvar] = c_enc
+    return encoding
+
+
+def _clip_block(values, valid_range=None, name=None):
+    ''' Clip values to valid_range (NaN are kept), with a warning if any value is changed.'''
+    (vmin, vmax) = valid_range
+    if ((values < vmin) | (values > vmax)).any():
+        warnings.warn('Values of '+name+' outside of '+str(valid_range)+' are clipped to fit uint16, '
+                      'write with mode=\'float32\' to keep them.')
+    return np.clip(values, vmin, vmax)
+
+
+def write_sipn_nc(ds, f_out, mode='float32', chunk_bytes=4*1024**2, complevel=1):
+    ''' Write regridded model output (after expand_to_sipn_dims) compactly, see get_sipn_nc_encoding.
+    mode=None writes as before (uncompressed, native dtype).'''
+    ds = expand_to_sipn_dims(ds).copy()
+    if mode is None:
+        ds.to_netcdf(f_out)
+        return
+    if mode == 'uint16': # Out of range values would wrap around
+        for cvar in SIPN_NC_PACKING:
+            if cvar in ds.data_vars:
+                # Clipped (and checked) block by block as written, so dask inputs are computed once
+                ds[cvar] = xr.apply_ufunc(_clip_block, ds[cvar], kwargs={'name': cvar,
+                                          'valid_range': SIPN_NC_PACKING[cvar]['valid_range']},
+                                          dask='parallelized', output_dtypes=[ds[cvar].dtype], keep_attrs=True)
+                # Packed (as stored) like the data, see get_sipn_nc_encoding
+                ds[cvar].attrs['valid_range'] = np.array([0, 65534], dtype=np.uint16)
+    ds.to_netcdf(f_out, encoding=get_sipn_nc_encoding(ds, mode=mode, chunk_bytes=chunk_bytes, complevel=complevel))
+
+
 def parse_NSIDC_date(str1):
     date1 = str1.split('_')[1]
     yyyy = int(date1[0:4])
@@ -398,31 +466,35 @@ def parse_NSIDC_date(str1):
     return datetime.datetime(yyyy,mm,dd)
 
 
+# Layout of the NSIDC polar stereographic (25 km) binary products
+# header: bytes to skip, ice_max: raw value of 100% sic, others: raw flag values
+NSIDC_PRODUCTS = {'NSIDC_0051': {'header':300, 'dtype':np.uint8, 'ice_max':250,
+                                 'hole_mask':251, 'coast':253, 'land':254, 'missing':255},
+                  'NSIDC_0081': {'header':300, 'dtype':np.uint8, 'ice_max':250,
+                                 'hole_mask':251, 'coast':253, 'land':254, 'missing':255},
+                  'NSIDC_0079': {'header':0, 'dtype':np.uint16, 'ice_max':1000,
+                                 'hole_mask':1100, 'coast':9999, 'land':1200, 'missing':9999}}
+
+NSIDC_SHAPE = (448, 304) # (n_rows, n_cols) i.e. (y, x)
+
+
+def get_NSIDC_product(product=None):
+    ''' Return the binary layout dictionary of a NSIDC product.'''
+    if product not in NSIDC_PRODUCTS:
+        raise ValueError('product name not found')
+    return NSIDC_PRODUCTS[product]
+
+
 def read_NSIDC_binary(cfile, x, y, product=None):
-    n_rows=448
-    n_cols=304
+    #http://nsidc.org/data/nsidc-0051
+    #http://nsidc.org/data/nsidc-0081
+    info = get_NSIDC_product(product)
     with open(cfile, 'rb') as fr:
-        if product=='NSIDC_0051' or product=='NSIDC_0081':
-            #http://nsidc.org/data/nsidc-0051
-            #http://nsidc.org/data/nsidc-0081
-            hdr = fr.read(300)
-            ice = np.fromfile(fr, dtype=np.uint8)
-            ice = ice.reshape(n_rows, n_cols)
-            ice_max = 250
-            hole_mask = 251
-            coast = 253
-            land = 254
-            missing = 255
-        elif product=='NSIDC_0079':
-            ice = np.fromfile(fr, dtype=np.uint16)
-            ice = ice.reshape(n_rows, n_cols)
-            ice_max = 1000.
-            hole_mask = 1100
-            coast = 9999
-            land = 1200
-            missing = 9999
-        else:
-            raise ValueError('product name not found')
+        hdr = fr.read(info['header'])
+        ice = np.fromfile(fr, dtype=info['dtype'])
+        ice = ice.reshape(NSIDC_SHAPE)
+    ice_max = float(info['ice_max'])
+    hole_mask = info['hole_mask']
 
     # Make xarray dataArray
     da_all = xr.DataArray(ice, coords={'x': x, 'y': y}, dims=('y', 'x'))
@@ -436,10 +508,86 @@ def read_NSIDC_binary(cfile, x, y, product=None):
     #if get_masks:
     # Add other masks
     ds.coords['hole_mask'] = da_all==hole_mask
-    #ds.coords['coast'] = da_all==coast # Commented out because makes filse too slow to load, and not used.
-    #ds.coords['land'] = da_all==land
-    #ds.coords['missing'] = da_all==missing
+    # coast, land and missing are static, see grid_masks.build_surface_masks and attach_surface_masks
+
+    return ds
+
+
+def guess_NSIDC_product(filename):
+    ''' Guess the NSIDC product from a native binary file name.
+    bt_* are Bootstrap (NSIDC_0079), nt_*nrt* are near real time (NSIDC_0081), other nt_* are NSIDC_0051.'''
+    fname = os.path.basename(filename)
+    if fname.startswith('bt_'):
+        return 'NSIDC_0079'
+    elif fname.startswith('nt_') & ('nrt' in fname):
+        return 'NSIDC_0081'
+    elif fname.startswith('nt_'):
+        return 'NSIDC_0051'
+    else:
+        raise ValueError('Could not guess NSIDC product from file name '+fname)
 
+
+def get_NSIDC_xm_ym():
+    ''' Stereo projected coordinates (m) of the NSIDC 25 km grid cell centers.'''
+    dx = dy = 25000
+    xm = np.arange(-3850000, +3750000, +dx)
+    ym = np.arange(+5850000, -5350000, -dy)
+    return (xr.DataArray(xm, dims=('x')), xr.DataArray(ym, dims=('y')))
+
+
+def memmap_NSIDC_binary(cfile, product=None):
+    ''' Memory-map the raw (uint8/uint16) codes of one NSIDC binary file. Nothing is read until accessed.'''
+    info = get_NSIDC_product(product)
+    return np.memmap(cfile, dtype=info['dtype'], mode='r', offset=info['header'], shape=NSIDC_SHAPE)
+
+
+def decode_NSIDC_sic(raw, product=None, dtype=np.float32):
+    ''' Scale raw NSIDC codes to sic (0-1). Non-sic codes (pole hole, land, etc.) become NaN.
+    Works on numpy and dask arrays (dask arrays stay lazy).'''
+    info = get_NSIDC_product(product)
+    sic = raw.astype(dtype) / dtype(info['ice_max'])
+    return np.where(raw <= info['ice_max'], sic, dtype(np.nan))
+
+
+def open_NSIDC_batch(all_files=None, product=None, decode=True):
+    ''' Lazily opens many NSIDC binary files as one (time, y, x) Dataset.
+    ----------
+    Parameters:
+    all_files : List
+        Paths of NSIDC binary files (all of one product)
+    product : String
+        NSIDC product name (i.e. NSIDC_0081)
+    decode : Boolean
+        If True, sic is decoded to float32 fractions (0-1) and hole_mask is added.
+        If False, sic holds the raw uint8/uint16 codes with scale_factor/flag attrs.
+
+    Returns:
+    ds = Dask Dataset
+        Each file is one memory-map and one dask chunk. Decoding only happens on compute.
+    '''
+    import dask.array as dsa
+
+    if not all_files:
+        raise ValueError('No files given.')
+    info = get_NSIDC_product(product)
+
+    # One mmap per file, stacked along time (no data is read here)
+    raw = dsa.stack([dsa.from_array(memmap_NSIDC_binary(cf, product), chunks=NSIDC_SHAPE,
+                                    name='nsidc-'+os.path.abspath(cf))
+                     for cf in all_files])
+    time = [parse_NSIDC_date(os.path.basename(cf)) for cf in all_files]
+    coords = {'time':time, 'y':np.arange(0, NSIDC_SHAPE[0], 1), 'x':np.arange(0, NSIDC_SHAPE[1], 1)}
+
+    if not decode:
+        da_raw = xr.DataArray(raw, dims=('time', 'y', 'x'), coords=coords, name='sic')
+        da_raw.attrs = {'scale_factor':1./info['ice_max'], 'valid_max':info['ice_max'],
+                        'flag_hole_mask':info['hole_mask'], 'flag_coast':info['coast'],
+                        'flag_land':info['land'], 'flag_missing':info['missing']}
+        return da_raw.to_dataset()
+
+    sic = decode_NSIDC_sic(raw, product)
+    ds = xr.DataArray(sic, dims=('time', 'y', 'x'), coords=coords, name='sic').to_dataset()
+    ds.coords['hole_mask'] = (('time', 'y', 'x'), raw == info['hole_mask'])
     return ds
 
 
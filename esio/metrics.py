@@ -65,6 +65,42 @@ def agg_by_domain(da_grid=None, ds_region=None, extent_thress=0.15, fill_pole_ho
             ds_list.append(da_avg)
     return xr.concat(ds_list, dim='nregions')
 
+def calc_region_extent_area(da_sic=None, ds_region=None, extent_thress=0.15, block=100):
+    ''' Returns a (time x nregions) Dataset of extent, area and extent with the pole hole filled
+    (extent_hole) in millions of km^2, for all regions at once (same regions as agg_by_domain).
+    Each block of days is reduced by one sparse matrix product instead of one mask per region.'''
+    import scipy.sparse
+
+    # Regions to keep (exclude some regions)
+    regions = [cd for cd in ds_region.nregions.values
+               if ds_region.region_names.sel(nregions=cd).values not in ['Ice-free Oceans', 'null','land outline', 'land' ]]
+
+    # Sparse (cell x region) matrix of cell areas
+    labels = ds_region.mask.transpose('y', 'x').values.ravel()
+    area = ds_region.area.transpose('y', 'x').values.ravel()
+    (cells, region_i) = np.nonzero(labels[:, None] == np.array(regions)[None, :])
+    M_area = scipy.sparse.csr_matrix((area[cells], (cells, region_i)), shape=(labels.size, len(regions)))
+
+    da_sic = da_sic.transpose('time', 'y', 'x')
+    out = {'extent': [], 'area': [], 'extent_hole': []}
+    for i_start in range(0, da_sic.time.size, block):
+        c_da = da_sic.isel(time=slice(i_start, i_start+block)).load()
+        sic = c_da.values.reshape(c_da.time.size, -1)
+        ext = M_area.T.dot((sic >= extent_thress).T.astype(np.float64)).T
+        out['extent'].append(ext)
+        out['area'].append(M_area.T.dot(np.nan_to_num(sic).T.astype(np.float64)).T)
+        if 'hole_mask' in c_da.coords:
+            hole = c_da.hole_mask.transpose('time', 'y', 'x').values.reshape(c_da.time.size, -1)
+            ext = ext + M_area.T.dot(hole.T.astype(np.float64)).T
+        out['extent_hole'].append(ext)
+
+    ds_out = xr.Dataset({k: (('time', 'nregions'), np.concatenate(v, axis=0)/(10**6)) for (k, v) in out.items()},
+                        coords={'time': da_sic.time, 'nregions': regions})
+    ds_out.coords['region_names'] = ds_region.region_names.sel(nregions=regions).drop_vars(
+        [x for x in ds_region.region_names.coords if x != 'nregions'])
+    return ds_out
+
+
 def agg_metric_domain(da_grid=None, ds_region=None):
 
     ds_list = []
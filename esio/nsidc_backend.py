@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import xarray as xr
+from xarray.backends import BackendArray, BackendEntrypoint
+from xarray.core import indexing
+
+from . import import_data
+
+
+class NSIDCBackendArray(BackendArray):
+    """ Lazy (time=1, y, x) view of one NSIDC binary file, decoded on access. """
+
+    def __init__(self, filename, product=None, kind='sic'):
+        self.filename = filename
+        self.product = product
+        self.kind = kind
+        self.shape = (1,) + import_data.NSIDC_SHAPE
+        if kind == 'sic':
+            self.dtype = np.dtype(np.float32)
+        elif kind == 'hole_mask':
+            self.dtype = np.dtype(bool)
+        else:
+            raise ValueError('kind must be sic or hole_mask')
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.BASIC,
+                                                  self._raw_indexing_method)
+
+    def _raw_indexing_method(self, key):
+        # Only the requested rows are paged in from the memory-map
+        raw = import_data.memmap_NSIDC_binary(self.filename, self.product)[np.newaxis][key]
+        if self.kind == 'sic':
+            return import_data.decode_NSIDC_sic(raw, self.product)
+        info = import_data.get_NSIDC_product(self.product)
+        return np.asarray(raw == info['hole_mask'])
+
+
+class NSIDCBackendEntrypoint(BackendEntrypoint):
+    """ xarray backend for native NSIDC (0051, 0079, 0081) polar stereographic binary files.
+
+    Usage: xr.open_dataset(f, engine='esio_nsidc') or
+           xr.open_mfdataset(files, engine='esio_nsidc', combine='nested', concat_dim='time')
+    Optional arguments are product (guessed from the file name if missing) and grid_dir
+    (directory with psn25lats_v3.dat/psn25lons_v3.dat, used to add lat and lon).
+    """
+
+    description = "Open native NSIDC sea ice concentration binary files lazily"
+    open_dataset_parameters = ('filename_or_obj', 'drop_variables', 'product', 'grid_dir')
+
+    def open_dataset(self, filename_or_obj, *, drop_variables=None, product=None, grid_dir=None):
+        filename = os.fspath(filename_or_obj)
+        if product is None:
+            product = import_data.guess_NSIDC_product(filename)
+
+        dims = ('time', 'y', 'x')
+        sic = xr.Variable(dims, indexing.LazilyIndexedArray(NSIDCBackendArray(filename, product, 'sic')),
+                          encoding={'preferred_chunks': {'time': 1}})
+        hole_mask = xr.Variable(dims, indexing.LazilyIndexedArray(NSIDCBackendArray(filename, product, 'hole_mask')))
+
+        ds = xr.Dataset({'sic': sic},
+                        coords={'time': [import_data.parse_NSIDC_date(os.path.basename(filename))],
+                                'y': np.arange(0, import_data.NSIDC_SHAPE[0], 1),
+                                'x': np.arange(0, import_data.NSIDC_SHAPE[1], 1),
+                                'hole_mask': hole_mask})
+        (ds.coords['xm'], ds.coords['ym']) = import_data.get_NSIDC_xm_ym()
+
+        # Add lat and lon dimensions
+        if grid_dir:
+            ds_lat_lon = import_data.get_stero_N_grid(grid_dir=grid_dir)
+            ds.coords['lat'] = ds_lat_lon.lat
+            ds.coords['lon'] = ds_lat_lon.lon
+
+        ds.attrs['product'] = product
+        if drop_variables:
+            ds = ds.drop_vars(drop_variables, errors='ignore')
+        return ds
+
+    def guess_can_open(self, filename_or_obj):
+        try:
+            filename = os.fspath(filename_or_obj)
+        except TypeError:
+            return False
+        if not filename.endswith('.bin'):
+            return False
+        try:
+            import_data.guess_NSIDC_product(filename)
+        except ValueError:
+            return False
+        return True
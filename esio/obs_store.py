@@ -0,0 +1,624 @@
+import concurrent.futures
+import multiprocessing
+import os
+import shutil
+import timeit
+
+import dask.array as dsa
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from . import grid_masks
+from . import import_data
+from . import metrics
+
+
+def year_store_path(out_dir, year):
+    ''' Path of the chunked store holding one year of observations.'''
+    return os.path.join(out_dir, str(year)+'.zarr')
+
+
+def group_files_by_year(all_files):
+    ''' Sort NSIDC binary files by date and group them by year.
+    Returns a dict of year -> (list of files, list of dates).'''
+    dates = [import_data.parse_NSIDC_date(os.path.basename(cf)) for cf in all_files]
+    by_year = {}
+    for (cdate, cf) in sorted(zip(dates, all_files)):
+        c_files, c_dates = by_year.setdefault(cdate.year, ([], []))
+        if c_dates and c_dates[-1] == cdate:
+            raise ValueError('Found more than one file for '+str(cdate)+' (mixed versions?)')
+        c_files.append(cf)
+        c_dates.append(cdate)
+    return by_year
+
+
+def get_sic_encoding(product=None):
+    ''' On-disk encoding of observed sic: the native integer codes (uint8/uint16) with
+    scale_factor back to 0-1 and the max integer as _FillValue (NaN).'''
+    info = import_data.get_NSIDC_product(product)
+    return {'dtype': np.dtype(info['dtype']).name,
+            'scale_factor': 1./info['ice_max'],
+            '_FillValue': np.iinfo(info['dtype']).max}
+
+
+def _packbits(mask):
+    return np.packbits(mask.reshape(mask.shape[0], -1), axis=1)
+
+
+def _unpackbits(packed, shape=None):
+    n_bits = int(np.prod(shape))
+    return np.unpackbits(packed, axis=1, count=n_bits).reshape((packed.shape[0],)+tuple(shape)).astype(bool)
+
+
+def pack_mask(da_mask):
+    ''' Pack a boolean (time, y, x) mask into a (time, n_bytes) uint8 bit-mask (8x smaller).'''
+    time_dim = da_mask.dims[0]
+    shape = da_mask.shape[1:]
+    n_bytes = int(np.ceil(np.prod(shape) / 8.))
+    data = da_mask.data
+    if isinstance(data, dsa.Array):
+        data = data.rechunk({1: -1, 2: -1})
+        packed = data.map_blocks(_packbits, dtype=np.uint8, drop_axis=2,
+                                 chunks=(data.chunks[0], (n_bytes,)))
+    else:
+        packed = _packbits(np.asarray(data))
+    return xr.DataArray(packed, dims=(time_dim, da_mask.name+'_bytes'), coords={time_dim: da_mask[time_dim]},
+                        name=da_mask.name+'_packed',
+                        attrs={'packed_dims': ' '.join(da_mask.dims[1:]),
+                               'packed_shape': list(shape)})
+
+
+def unpack_mask(da_packed):
+    ''' Inverse of pack_mask, stays lazy for dask arrays.'''
+    time_dim = da_packed.dims[0]
+    shape = tuple(int(x) for x in np.atleast_1d(da_packed.attrs['packed_shape']))
+    dims = (time_dim,) + tuple(da_packed.attrs['packed_dims'].split(' '))
+    data = da_packed.data
+    if isinstance(data, dsa.Array):
+        data = data.rechunk({1: -1})
+        mask = data.map_blocks(_unpackbits, shape=shape, dtype=bool, drop_axis=1,
+                               new_axis=list(range(1, len(shape)+1)),
+                               chunks=(data.chunks[0],)+tuple((n,) for n in shape))
+    else:
+        mask = _unpackbits(np.asarray(data), shape=shape)
+    return xr.DataArray(mask, dims=dims, coords={time_dim: da_packed[time_dim]})
+
+
+# Encoding keys kept from the source of each variable (CF decoding), the backend specific ones
+# (chunks, compressors, zlib, ...) of the store it was read from would conflict with the new layout
+CF_ENCODING_KEYS = ['units', 'calendar', 'dtype', '_FillValue', 'missing_value', 'scale_factor', 'add_offset']
+
+
+def encode_obs(ds, product=None):
+    ''' Returns ds ready to be written compactly: sic keeps its integer codes (see get_sic_encoding)
+    and hole_mask is replaced by the packed hole_mask_packed bit-mask.'''
+    ds = ds.copy()
+    if 'hole_mask' in ds.variables:
+        ds['hole_mask_packed'] = pack_mask(ds.hole_mask)
+        ds = ds.drop_vars('hole_mask')
+    for cvar in ds.variables:
+        ds[cvar].encoding = {k: v for (k, v) in ds[cvar].encoding.items() if k in CF_ENCODING_KEYS}
+    if 'sic' in ds.data_vars:
+        ds['sic'].encoding = get_sic_encoding(product)
+    return ds
+
+
+def decode_obs(ds):
+    ''' Inverse of encode_obs (sic is decoded by xarray, here we only unpack the masks).'''
+    for cvar in [x for x in ds.variables if x.endswith('_packed')]:
+        ds.coords[cvar.replace('_packed', '')] = unpack_mask(ds[cvar])
+        ds = ds.drop_vars(cvar)
+    return ds
+
+
+def open_obs(paths, hole_mask_table=None, surface_masks=None, **kwargs):
+    ''' Open observations written by esio (zarr store(s) or netcdf file(s)) and decode them.
+    If stored without hole_mask, it is attached lazily from hole_mask_table (see grid_masks) when given.
+    The static coast, land and missing masks are attached from surface_masks when given.'''
+    if isinstance(paths, str) and (paths.rstrip('/').endswith('.zarr') or os.path.isdir(paths)):
+        ds = xr.open_zarr(paths, **kwargs)
+    elif isinstance(paths, str) and os.path.isfile(paths):
+        ds = xr.open_dataset(paths, chunks={}, **kwargs)
+    elif all(str(x).rstrip('/').endswith('.zarr') for x in np.atleast_1d(paths)):
+        ds = xr.open_mfdataset(sorted(paths), engine='zarr', combine='by_coords', **kwargs)
+    else:
+        ds = xr.open_mfdataset(paths, combine='by_coords', **kwargs)
+    ds = decode_obs(ds)
+    if (hole_mask_table is not None) and ('hole_mask' not in ds.coords):
+        ds = grid_masks.attach_hole_mask(ds, hole_mask_table)
+    if surface_masks is not None:
+        ds = grid_masks.attach_surface_masks(ds, surface_masks)
+    return ds
+
+
+def write_obs(ds, path, product=None, mode='w', hole_mask=True):
+    ''' Write observations compactly to a netcdf file (.nc) or zarr store (any other path).
+    hole_mask=False leaves out the daily pole hole (re-attached from the era table by open_obs).'''
+    if not hole_mask:
+        ds = ds.drop_vars('hole_mask', errors='ignore')
+    ds = encode_obs(ds, product=product)
+    if not path.endswith('.nc'):
+        ds.to_zarr(path, mode=mode)
+    else:
+        encoding = {x: {'zlib': True} for x in ds.data_vars}
+        if 'sic' in ds.data_vars:
+            encoding['sic'].update(get_sic_encoding(product))
+        ds.to_netcdf(path, mode=mode, encoding=encoding)
+
+
+def init_NSIDC_year_store(store, times, product=None, block=32):
+    ''' Write the empty layout (coords and chunking, but no data) of a yearly NSIDC store.
+    sic is chunked one day per chunk (maps), the packed hole_mask, extent and area by block.
+    Blocks of days starting at multiples of block can then be written concurrently.'''
+    (ny, nx) = import_data.NSIDC_SHAPE
+    nt = len(times)
+    dims = ('time', 'y', 'x')
+    ds = xr.Dataset({'sic': (dims, dsa.zeros((nt, ny, nx), chunks=(1, ny, nx), dtype=np.float32)),
+                     'extent': (('time',), dsa.zeros(nt, chunks=block, dtype=np.float64)),
+                     'area': (('time',), dsa.zeros(nt, chunks=block, dtype=np.float64))},
+                    coords={'time': times,
+                            'y': np.arange(0, ny, 1),
+                            'x': np.arange(0, nx, 1),
+                            'hole_mask': (dims, dsa.zeros((nt, ny, nx), chunks=(block, ny, nx), dtype=bool))})
+    (ds.coords['xm'], ds.coords['ym']) = import_data.get_NSIDC_xm_ym()
+    encode_obs(ds, product=product).to_zarr(store, mode='w', compute=False)
+
+
+def calc_NSIDC_extent_area(ds_sic, ds_region):
+    ''' Add pan-Arctic extent (pole hole filled) and area (no pole hole) in millions of km^2.'''
+    ds_sic['extent'] = metrics.calc_extent(ds_sic.sic, ds_region, fill_pole_hole=True)
+    ds_sic['area'] = (ds_sic.sic * ds_region.area).sum(dim='x').sum(dim='y')/(10**6)
+    return ds_sic
+
+
+def load_NSIDC_files(files, product, ds_region):
+    ''' Decode NSIDC binary files and add extent and area.'''
+    ds = import_data.open_NSIDC_batch(files, product=product).load()
+    (ds.coords['xm'], ds.coords['ym']) = import_data.get_NSIDC_xm_ym()
+    return calc_NSIDC_extent_area(ds, ds_region)
+
+
+def _time_vars_only(ds, time_dim='time'):
+    ''' Drop variables without a time dim (already in a store we write to by time).'''
+    return ds.drop_vars([x for x in ds.variables if time_dim not in ds[x].dims])
+
+
+def _import_NSIDC_block(files, product, store, i_start, ds_region):
+    ''' Decode a block of files and write them into their time region of a yearly store.'''
+    ds = encode_obs(load_NSIDC_files(files, product, ds_region), product=product)
+    # Only write variables along time (the rest are written by init_NSIDC_year_store)
+    ds = _time_vars_only(ds)
+    ds.to_zarr(store, region={'time': slice(i_start, i_start + len(files))})
+    return len(files)
+
+
+def bulk_import_NSIDC(all_files=None, product=None, out_dir=None, ds_region=None,
+                      n_workers=None, block=32, table_store=None):
+    ''' Imports many NSIDC binary files in parallel into per-year chunked stores.
+    ----------
+    Parameters:
+    all_files : List
+        Paths of native NSIDC binary files (one product, one file per day)
+    product : String
+        NSIDC product name (i.e. NSIDC_0051)
+    out_dir : String
+        Directory of the yearly stores (<out_dir>/<year>.zarr are overwritten)
+    ds_region : Dataset
+        Region mask and cell area (i.e. sio_2016_mask_Update.nc)
+    n_workers : int
+        Number of worker processes (default is number of cpus)
+    block : int
+        Number of days decoded and written by each task
+    table_store : String
+        (optional) regional extent/area table (see update_extent_table), the days imported are
+        computed again from the new stores (days of other years are kept)
+
+    Returns:
+    files_per_sec = float
+        Throughput of the import
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    ds_region = ds_region.load() # Send in memory copy to workers
+
+    # Lay out every yearly store, then split each year into blocks
+    tasks = []
+    for (cyear, (c_files, c_dates)) in group_files_by_year(all_files).items():
+        store = year_store_path(out_dir, cyear)
+        init_NSIDC_year_store(store, c_dates, product=product, block=block)
+        for i_start in range(0, len(c_files), block):
+            tasks.append((c_files[i_start:i_start+block], product, store, i_start))
+
+    start_time = timeit.default_timer()
+    n_files = 0
+    # spawn (not fork), forking a process that already runs dask threads can deadlock
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(_import_NSIDC_block, *t, ds_region) for t in tasks]
+        for f in concurrent.futures.as_completed(futures):
+            n_files = n_files + f.result()
+    elapsed = timeit.default_timer() - start_time
+
+    files_per_sec = n_files / max(elapsed, 1e-9)
+    print('Imported', n_files, 'files in', round(elapsed, 1), 'seconds (',
+          round(files_per_sec, 1), 'files per second).')
+
+    if table_store:
+        ds_all = open_obs(sorted(set(t[2] for t in tasks))) # Only the yearly stores just written
+        update_extent_table(ds_all, ds_region, table_store, rebuild=True)
+    return files_per_sec
+
+
+def get_store_times(store, time_dim='time'):
+    ''' Return the times (days) present in a store, empty if the store does not exist yet.'''
+    if not os.path.exists(store):
+        return np.array([], dtype='datetime64[ns]')
+    return xr.open_zarr(store)[time_dim].values
+
+
+def append_new_times(ds_new, store, time_dim='time', chunks={'time':1}):
+    ''' Appends the times of ds_new that are not yet in store (created if missing).
+    Returns number of appended times. Times must be newer than the last time stored.'''
+    have_times = get_store_times(store, time_dim=time_dim)
+    ds_new = ds_new.sortby(time_dim)
+    is_new = ~np.isin(ds_new[time_dim].values, have_times)
+    if not is_new.any():
+        return 0
+    ds_new = ds_new.isel({time_dim: np.where(is_new)[0]})
+
+    if have_times.size == 0:
+        ds_new.chunk(chunks).to_zarr(store, mode='w')
+    else:
+        if ds_new[time_dim].values[0] <= have_times.max():
+            raise ValueError('New times are older than the last time in '+store+', rebuild the store instead.')
+        _time_vars_only(ds_new, time_dim=time_dim).to_zarr(store, append_dim=time_dim)
+    return int(is_new.sum())
+
+
+def append_NSIDC_days(all_files=None, product=None, out_dir=None, ds_region=None, table_store=None):
+    ''' Append only the newly arrived days of native NSIDC files to the yearly stores.
+    ----------
+    Parameters:
+    all_files : List
+        Paths of all native NSIDC binary files of one product
+    product : String
+        NSIDC product name (i.e. NSIDC_0081)
+    out_dir : String
+        Directory of the yearly stores (<out_dir>/<year>.zarr)
+    ds_region : Dataset
+        Region mask and cell area (i.e. sio_2016_mask_Update.nc)
+    table_store : String
+        (optional) regional extent/area table (see update_extent_table) to also update
+
+    Returns:
+    n_new = int
+        Number of days appended
+    '''
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    n_new = 0
+    for (cyear, (c_files, c_dates)) in group_files_by_year(all_files).items():
+        store = year_store_path(out_dir, cyear)
+        have_times = get_store_times(store)
+        if len(have_times) == len(c_dates):
+            continue # Year is complete
+        new_files = [cf for (cf, cd) in zip(c_files, c_dates) if np.datetime64(cd, 'ns') not in have_times]
+        if not new_files:
+            continue
+
+        new_dates = np.array(c_dates, dtype='datetime64[ns]')[np.isin(c_files, new_files)]
+        if have_times.size and (new_dates.min() <= have_times.max()):
+            # A day arrived late (back fill), rebuild this year only
+            print('Found days older than last day stored, rebuilding', cyear)
+            ds_year = load_NSIDC_files(c_files, product, ds_region)
+            encode_obs(ds_year, product=product).chunk({'time':1}).to_zarr(store, mode='w')
+            if table_store:
+                update_extent_table(ds_year, ds_region, table_store)
+            n_new = n_new + len(new_files)
+            continue
+
+        ds_new = load_NSIDC_files(new_files, product, ds_region)
+        n_new = n_new + append_new_times(encode_obs(ds_new, product=product), store)
+        if table_store:
+            update_extent_table(ds_new, ds_region, table_store)
+    print('Appended', n_new, 'new days.')
+    return n_new
+
+
+# Chunking of the two layouts of an observation store
+MAP_CHUNKS = {'time': 1, 'y': -1, 'x': -1} # one day per chunk (maps)
+TIMESERIES_CHUNKS = {'time': 365, 'y': 56, 'x': 38} # long time, small spatial tiles (per pixel series)
+
+# Which layout suits each access pattern
+ACCESS_LAYOUTS = {'map': 'map', 'daily': 'map', 'extent': 'map',
+                  'timeseries': 'timeseries', 'pixel': 'timeseries', 'climatology': 'timeseries'}
+
+
+def get_obs_store_path(E=None, product=None, layout='map'):
+    ''' Path of the zarr copy of an observation product in a given layout.'''
+    if layout == 'map':
+        return os.path.join(E.obs_dir, 'zarr', product)
+    elif layout == 'timeseries':
+        return os.path.join(E.obs_dir, 'zarr', product+'_timeseries')
+    else:
+        raise ValueError('layout must be map or timeseries')
+
+
+def sync_timeseries_store(ds_map=None, store=None, product=None, chunks=TIMESERIES_CHUNKS):
+    ''' Keep a time-series (long time, small spatial tile) copy of observations in sync.
+    ----------
+    Parameters:
+    ds_map : Dataset
+        Observations in the map layout (i.e. from open_obs)
+    store : String
+        Path of the time-series zarr store (created if missing)
+    product : String
+        NSIDC product name, for the compact encoding
+    chunks : dict
+        Chunk sizes of the time-series layout
+
+    Returns:
+    n_new = int
+        Number of times added. Only times missing from store are written, in blocks of
+        chunks['time'] so each append only touches the last time chunk of each tile.
+    '''
+    have_times = get_store_times(store)
+    is_new = ~np.isin(ds_map.time.values, have_times)
+    if not is_new.any():
+        return 0
+    new_times = ds_map.time.values[is_new]
+    if have_times.size and (new_times.min() <= have_times.max()):
+        raise ValueError('New times are older than the last time in '+store+', rebuild the store instead.')
+    ds_new = ds_map.sel(time=new_times)
+
+    if have_times.size == 0:
+        # Build the full copy, rechunked (encode_obs drops the chunks/codecs encoding of the map store)
+        ds_new = encode_obs(ds_new, product=product)
+        ds_new = ds_new.chunk({k: v for (k, v) in chunks.items() if k in ds_new.dims})
+        ds_new.to_zarr(store, mode='w')
+        return new_times.size
+
+    # Append in memory blocks of up to one time chunk
+    n_time = chunks['time']
+    for i_start in range(0, new_times.size, n_time):
+        ds_block = ds_new.isel(time=slice(i_start, i_start + n_time)).load()
+        _time_vars_only(encode_obs(ds_block, product=product)).to_zarr(store, append_dim='time')
+    return new_times.size
+
+
+def open_obs_for_access(E=None, product=None, access='map'):
+    ''' Open an observation product from the layout that suits how it will be read.
+    access : map/daily/extent (one or few days of full grids) or
+             timeseries/pixel/climatology (long records over (part of) the grid, i.e. calc_IFD, detrend)
+    Falls back to the map layout if the time-series copy has not been made.'''
+    if access not in ACCESS_LAYOUTS:
+        raise ValueError('access not found, use one of '+', '.join(ACCESS_LAYOUTS.keys()))
+    layout = ACCESS_LAYOUTS[access]
+    store = get_obs_store_path(E=E, product=product, layout=layout)
+    if (layout == 'timeseries') and not os.path.exists(store):
+        print('No time-series copy of', product, 'found, using the map layout.')
+        store = get_obs_store_path(E=E, product=product, layout='map')
+    return open_obs(store)
+
+
+def update_extent_table(ds_sic=None, ds_region=None, store=None, rebuild=False):
+    ''' Add the days of ds_sic missing from a (time x nregions) table of extent, area and
+    extent_hole (pole hole filled) in millions of km^2 (see metrics.calc_region_extent_area).
+    Days older than the last day of the table (late arrivals) are inserted in time order.
+    If rebuild, the days of ds_sic already in the table are computed again (other days are kept).
+    Returns number of days added (or computed again).'''
+    have_times = get_store_times(store)
+    new_times = ds_sic.time.values
+    if not rebuild:
+        new_times = new_times[~np.isin(new_times, have_times)]
+    if new_times.size == 0:
+        return 0
+    ds_table = metrics.calc_region_extent_area(ds_sic.sic.sel(time=new_times), ds_region)
+    if have_times.size and (rebuild or (new_times.min() <= have_times.max())):
+        # Insert out of order (or replace) days: the table is small, rewrite it sorted
+        ds_have = xr.open_zarr(store).load()
+        ds_have = ds_have.isel(time=~np.isin(ds_have.time.values, new_times))
+        ds_all = xr.concat([ds_have, ds_table.load()], dim='time').sortby('time')
+        ds_all = encode_obs(ds_all) # drop the encoding of the store read
+        tmp_store = store.rstrip('/')+'.tmp'
+        ds_all.chunk({'time': 3650}).to_zarr(tmp_store, mode='w')
+        shutil.rmtree(store)
+        os.rename(tmp_store, store)
+        return new_times.size
+    return append_new_times(ds_table, store, chunks={'time': 3650})
+
+
+def load_extent_table(store=None, regions=None, panArctic=False):
+    ''' Load the observed regional extent/area table (a few kB per year).
+    ----------
+    Parameters:
+    store : String
+        Path of the table (see update_extent_table)
+    regions : List
+        (optional) nregions values to select
+    panArctic : Boolean
+        If True, return the sum over regions instead (pass ds_region.ocean_regions as regions
+        to match metrics.calc_extent(..., fill_pole_hole=True) with extent_hole)
+
+    Returns:
+    ds = Dataset
+        extent, area and extent_hole by time (and nregions)
+    '''
+    ds = xr.open_zarr(store).load()
+    if regions is not None:
+        ds = ds.sel(nregions=regions)
+    if panArctic:
+        ds = ds.sum(dim='nregions')
+    return ds
+
+
+# Source priority of the consolidated observation record (first is best, i.e. final replaces near real time)
+CONSOLIDATED_PRIORITY = ['NSIDC_0051', 'NSIDC_0081', 'NSIDC_0079']
+
+
+def _runs(index):
+    ''' Split sorted integer indices into slices of consecutive values.'''
+    if len(index) == 0:
+        return []
+    breaks = np.where(np.diff(index) != 1)[0] + 1
+    return [slice(c[0], c[-1]+1) for c in np.split(np.asarray(index), breaks)]
+
+
+def _consolidated_block(times, source_i, ds_products, priority):
+    ''' Build the consolidated (time, y, x) Dataset for some days from their chosen source.'''
+    (ny, nx) = import_data.NSIDC_SHAPE
+    sic = np.full((len(times), ny, nx), np.nan, dtype=np.float32)
+    hole_mask = np.zeros((len(times), ny, nx), dtype=bool)
+    for (i, product) in enumerate(priority):
+        idx = np.where(source_i == i)[0]
+        if idx.size == 0:
+            continue
+        ds_p = ds_products[product].sel(time=times[idx]).transpose('time', 'y', 'x')
+        sic[idx] = ds_p.sic.values
+        hole_mask[idx] = ds_p.hole_mask.values
+    ds = xr.Dataset({'sic': (('time', 'y', 'x'), sic),
+                     'source': (('time',), source_i.astype(np.int8))},
+                    coords={'time': times, 'hole_mask': (('time', 'y', 'x'), hole_mask),
+                            'y': np.arange(0, ny, 1), 'x': np.arange(0, nx, 1)})
+    ds.source.attrs = {'flag_values': list(range(-1, len(priority))),
+                       'flag_meanings': ' '.join(['none'] + priority)}
+    # uint16 codes scaled by 1/1000 (the NSIDC_0079 encoding) hold the 1/250 steps of 0051/0081 exactly
+    return encode_obs(ds, product='NSIDC_0079')
+
+
+def update_consolidated_obs(ds_products=None, store=None, priority=CONSOLIDATED_PRIORITY, block=64):
+    ''' Incrementally build one daily observation record from several NSIDC products.
+    ----------
+    Parameters:
+    ds_products : dict
+        product name -> decoded Dataset (time, y, x) with sic and hole_mask (i.e. from open_obs)
+    store : String
+        Path of the consolidated zarr store (created if missing)
+    priority : List
+        Products from best to worst. Each day uses the best product that has it, and is rewritten
+        when a better product becomes available (i.e. NSIDC_0051 replacing NSIDC_0081)
+    block : int
+        Number of days loaded in memory at once
+
+    Returns:
+    n_written = int
+        Number of days written (new or replaced)
+
+    The record has one entry per day between the first and last available day; the source
+    variable is the index of the product used (-1 if no product has that day).
+    '''
+    ds_products = {k: v for (k, v) in ds_products.items() if k in priority}
+    all_times = np.unique(np.concatenate([ds_products[p].time.values for p in ds_products]))
+    first_day = all_times.min().astype('datetime64[D]')
+
+    # What is already stored
+    if os.path.exists(store):
+        ds_have = xr.open_zarr(store)
+        have_times = ds_have.time.values
+        have_source = ds_have.source.values
+        if first_day < have_times[0]:
+            raise ValueError('New days are older than the first day in '+store+', rebuild the store instead.')
+        if (np.diff(have_times.astype('datetime64[D]')) != np.timedelta64(1, 'D')).any():
+            raise ValueError('Days are missing in '+store+', rebuild the store instead.')
+        # Days after the stored ones are all appended, so the record never has gaps
+        first_day = min(first_day, have_times.max().astype('datetime64[D]') + 1)
+    else:
+        have_times = np.array([], dtype='datetime64[ns]')
+        have_source = np.array([], dtype=int)
+
+    # Best available source of each day
+    days = np.arange(first_day, all_times.max().astype('datetime64[D]')+1,
+                     dtype='datetime64[D]').astype('datetime64[ns]')
+    best = np.full(days.size, -1, dtype=int)
+    for (i, product) in reversed(list(enumerate(priority))):
+        if product in ds_products:
+            best[np.isin(days, ds_products[product].time.values)] = i
+
+    # Replace stored days that now have a better (lower index) source
+    # (only stored days covered by the products passed in, the others are left untouched)
+    best_have = np.full(have_times.size, -1, dtype=int)
+    in_days = np.isin(have_times, days)
+    best_have[in_days] = best[np.searchsorted(days, have_times[in_days])]
+    better = np.where((best_have >= 0) & ((have_source < 0) | (best_have < have_source)))[0]
+    n_written = 0
+    for c_run in _runs(better):
+        for i_start in range(c_run.start, c_run.stop, block):
+            i_end = min(i_start + block, c_run.stop)
+            ds_block = _consolidated_block(have_times[i_start:i_end], best_have[i_start:i_end],
+                                           ds_products, priority)
+            _time_vars_only(ds_block).to_zarr(store, region={'time': slice(i_start, i_end)})
+            n_written = n_written + (i_end - i_start)
+
+    # Append new days
+    new = np.where(days > (have_times.max() if have_times.size else days[0] - np.timedelta64(1, 'D')))[0]
+    for i_start in range(0, new.size, block):
+        idx = new[i_start:i_start+block]
+        ds_block = _consolidated_block(days[idx], best[idx], ds_products, priority)
+        if not os.path.exists(store):
+            ds_block.chunk({'time': 1}).to_zarr(store, mode='w')
+        else:
+            _time_vars_only(ds_block).to_zarr(store, append_dim='time')
+        n_written = n_written + idx.size
+    return n_written
+
+
+def open_consolidated_obs(store=None, drop_missing=True, **kwargs):
+    ''' Open the consolidated observation record (see update_consolidated_obs).
+    drop_missing removes days without any product (by index, no data is read).'''
+    ds = open_obs(store, **kwargs)
+    if drop_missing:
+        ds = ds.isel(time=np.where(ds.source.values >= 0)[0])
+    return ds
+
+
+def list_year_partitions(in_dir=None):
+    ''' Return dict of year -> path of the yearly partitions (<year>.nc or <year>.zarr) in a directory.'''
+    parts = {}
+    for name in os.listdir(in_dir):
+        (stem, ext) = os.path.splitext(name)
+        if stem.isdigit() and (ext in ['.nc', '.zarr']):
+            parts[int(stem)] = os.path.join(in_dir, name)
+    return parts
+
+
+def open_obs_range(in_dir=None, start=None, end=None, last_days=None, **kwargs):
+    ''' Open only the yearly partitions (i.e. sipn_nc_yearly) that overlap a time range.
+    ----------
+    Parameters:
+    in_dir : String
+        Directory of yearly partitions
+    start, end : datetime like
+        Time range (inclusive), None for open ended
+    last_days : int
+        (optional) instead of start, keep the last_days days before the last time found (or before end)
+
+    Returns:
+    ds = Dataset
+        Subset by index (isel), no where(drop=True) pass over the data
+    '''
+    parts = list_year_partitions(in_dir)
+    if not parts:
+        raise ValueError('No yearly partitions found in '+in_dir)
+    end = pd.Timestamp(end) if end is not None else None
+    start = pd.Timestamp(start) if start is not None else None
+    last_year = max(parts) if end is None else min(end.year, max(parts))
+
+    if last_days is not None:
+        if end is None:
+            # Last time is in the most recent partition
+            end = pd.Timestamp(open_obs(parts[last_year]).time.values[-1])
+        start = end - pd.Timedelta(days=last_days)
+
+    years = [y for y in sorted(parts) if ((start is None) or (y >= start.year)) and (y <= last_year)]
+    if not years:
+        raise ValueError('No yearly partitions overlap the requested time range.')
+    paths = [parts[y] for y in years]
+    ds = open_obs(paths[0] if len(paths) == 1 else paths, **kwargs)
+
+    # Index based slice on the (sorted) time axis
+    times = ds.time.values
+    i_start = 0 if start is None else np.searchsorted(times, np.datetime64(start), side='left')
+    i_end = times.size if end is None else np.searchsorted(times, np.datetime64(end), side='right')
+    return ds.isel(time=slice(i_start, i_end))
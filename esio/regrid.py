@@ -0,0 +1,826 @@
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import traceback
+import uuid
+
+import numpy as np
+import scipy.sparse
+import scipy.spatial
+import xarray as xr
+
+
+def grid_hash(ds, varnames=('lat', 'lon', 'lat_b', 'lon_b', 'mask', 'land_frac')):
+    ''' Hash of the coordinates (centers, bounds, mask and land fraction if present) that define a grid.'''
+    h = hashlib.sha1()
+    for cvar in varnames:
+        if cvar not in ds.variables:
+            continue
+        values = np.ascontiguousarray(np.asarray(ds[cvar].values, dtype=np.float64))
+        h.update(cvar.encode())
+        h.update(str(values.shape).encode())
+        h.update(values.tobytes())
+    return h.hexdigest()
+
+
+def grid_shape(ds):
+    ''' 2D shape of a grid, from 2D lat/lon or from 1D lat and lon (regular grids).'''
+    if ds.lat.ndim == 1 and ds.lon.ndim == 1 and ds.lat.dims != ds.lon.dims:
+        return (ds.lat.size, ds.lon.size)
+    return ds.lat.shape
+
+
+def grid_dims(ds):
+    ''' 2D dims of a grid, (lat, lon) dims of regular grids with 1D lat and lon.'''
+    if ds.lat.ndim == 1 and ds.lon.ndim == 1 and ds.lat.dims != ds.lon.dims:
+        return ds.lat.dims + ds.lon.dims
+    return ds.lat.dims
+
+
+def grid_lat_lon(ds):
+    ''' 2D lat and lon arrays of a grid (1D lat and lon of regular grids are broadcast).'''
+    if ds.lat.ndim == 1 and ds.lon.ndim == 1 and ds.lat.dims != ds.lon.dims:
+        (lon, lat) = np.meshgrid(ds.lon.values, ds.lat.values)
+        return (lat, lon)
+    return (np.asarray(ds.lat.values), np.asarray(ds.lon.values))
+
+
+def lat_lon_to_xyz(lat, lon):
+    ''' (N, 3) cartesian coordinates on the unit sphere of lat/lon (degrees).'''
+    lat = np.deg2rad(np.asarray(lat, dtype=np.float64).ravel())
+    lon = np.deg2rad(np.asarray(lon, dtype=np.float64).ravel())
+    return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+
+class NearestIndex(object):
+    """ KD-tree over the cell centers of a source grid (3D unit sphere coords, so distances are
+    correct near the pole and across the dateline). Built once, answers batched queries.
+    """
+
+    def __init__(self, lat=None, lon=None, mask=None):
+        """"""
+        self.shape = np.shape(lat)
+        self.n_in = int(np.prod(self.shape))
+        self.valid = np.arange(self.n_in)
+        if mask is not None: # Only valid (True) source cells can be nearest
+            self.valid = np.flatnonzero(np.asarray(mask).ravel())
+        xyz = lat_lon_to_xyz(lat, lon)[self.valid]
+        self.tree = scipy.spatial.cKDTree(xyz)
+
+    def query(self, lat, lon, max_dist=None):
+        ''' Flat index (into the source grid) of the nearest cell of each point, and its great circle
+        distance (radians). Points farther than max_dist (radians) get index -1.'''
+        (chord, i) = self.tree.query(lat_lon_to_xyz(lat, lon))
+        dist = 2*np.arcsin(np.clip(chord/2., 0, 1))
+        index = self.valid[np.minimum(i, self.valid.size - 1)]
+        if max_dist is not None:
+            index[dist > max_dist] = -1
+        return (index, dist)
+
+    def weights(self, lat, lon, max_dist=None):
+        ''' (n_out x n_in) CSR nearest_s2d weights (a single 1 per row) for target points lat/lon.'''
+        (index, dist) = self.query(lat, lon, max_dist=max_dist)
+        rows = np.flatnonzero(index >= 0)
+        return scipy.sparse.csr_matrix((np.ones(rows.size), (rows, index[rows])), shape=(index.size, self.n_in))
+
+
+_nearest_indexes = {} # grid hash -> NearestIndex, so each source grid is only indexed once per process
+
+
+def get_nearest_index(ds):
+    ''' Return the (memoized) NearestIndex of a grid (using its mask variable if present).'''
+    key = grid_hash(ds, varnames=('lat', 'lon', 'mask'))
+    if key not in _nearest_indexes:
+        (lat, lon) = grid_lat_lon(ds)
+        _nearest_indexes[key] = NearestIndex(lat, lon, mask=ds['mask'].values if 'mask' in ds.variables else None)
+    return _nearest_indexes[key]
+
+
+def build_nearest_weights(ds_in, ds_out, method='nearest_s2d', max_dist=None):
+    ''' Weight builder (see WeightCache.get) for nearest_s2d using a KD-tree, does not need xesmf.'''
+    if method != 'nearest_s2d':
+        raise ValueError('Only nearest_s2d weights can be built by KD-tree, got '+method)
+    (lat, lon) = grid_lat_lon(ds_out)
+    return get_nearest_index(ds_in).weights(lat, lon, max_dist=max_dist)
+
+
+def _build_xesmf_weights(ds_in, ds_out, method, periodic=False):
+    ''' Default weight builder, returns the (n_out x n_in) sparse matrix made by xesmf (ESMF).'''
+    import xesmf as xe
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        regridder = xe.Regridder(ds_in, ds_out, method, periodic=periodic,
+                                 filename=os.path.join(tmp_dir, 'weights.nc'), reuse_weights=False)
+        if hasattr(regridder, 'A'): # xesmf < 0.4
+            A = regridder.A
+        else:
+            A = regridder.weights # scipy sparse (xesmf 0.5), DataArray of sparse.COO (xesmf >= 0.6)
+            A = A.data.to_scipy_sparse() if isinstance(A, xr.DataArray) else A
+    return scipy.sparse.csr_matrix(A)
+
+
+def default_builder(method):
+    ''' Weight builder used when none is given: KD-tree for nearest_s2d, else xesmf.'''
+    return build_nearest_weights if method == 'nearest_s2d' else _build_xesmf_weights
+
+
+def _to_full_grid(A_sub, index, n_in):
+    ''' Map the columns of sub grid weights to the cells (flat index, NaN if none) of the full grid.'''
+    A_sub = scipy.sparse.coo_matrix(A_sub)
+    index = np.asarray(index, dtype=np.float64).ravel()[A_sub.col]
+    has_cell = np.isfinite(index)
+    return scipy.sparse.csr_matrix((A_sub.data[has_cell], (A_sub.row[has_cell], index[has_cell].astype(np.int64))),
+                                   shape=(A_sub.shape[0], n_in))
+
+
+def build_gfdl_weights(ds_in, ds_out, method, split='GFDL', nj_split=175, nj_split_2=180, **kwargs):
+    ''' Weight builder (see WeightCache.get) for the GFDL tripolar grid. Builds weights for the "top"
+    and "bottom" sub grids of import_data.split_GFDL and merges them into one matrix of the full grid,
+    selecting target rows as regrid_gfdl_split_domain does (top where lat >= lat of the split and
+    top has weights, else bottom below lat_split_2). Use with split='GFDL' so the cache key differs
+    from unsplit weights of the same grid.'''
+    from . import import_data
+    if split != 'GFDL':
+        raise ValueError('Unknown split '+str(split))
+    ds_grid = ds_in[[x for x in ['lat', 'lon', 'lat_b', 'lon_b'] if x in ds_in.variables]]
+    ds_grid = ds_grid.reset_coords()
+    n_in = ds_grid.lat.size
+    # Pass the flat index of each cell through split_GFDL, to find where sub grid cells come from
+    ds_grid['cell_index'] = (ds_grid.lat.dims, np.arange(n_in, dtype=np.float64).reshape(ds_grid.lat.shape))
+    ds_grid = ds_grid.set_coords([x for x in ['lat', 'lon', 'lat_b', 'lon_b'] if x in ds_grid])
+    (ds_top, ds_bottom) = import_data.split_GFDL(ds_grid, varnames=['cell_index'])
+
+    builder = default_builder(method)
+    A_list = []
+    for ds_sub in [ds_top, ds_bottom]:
+        index = ds_sub.cell_index.transpose(*ds_sub.lat.dims).values
+        A_list.append(_to_full_grid(builder(ds_sub.drop_vars('cell_index'), ds_out, method, **kwargs), index, n_in))
+    (A_top, A_bottom) = A_list
+
+    lat_split = ds_in.lat.isel(nj=nj_split).min().values
+    lat_split_2 = ds_in.lat.isel(nj=nj_split_2).max().values
+    (lat_out, lon_out) = grid_lat_lon(ds_out)
+    lat_out = lat_out.ravel()
+    use_top = (lat_out >= lat_split) & ~empty_rows(A_top)
+    use_bottom = ~use_top & (lat_out < lat_split_2)
+    A = scipy.sparse.diags(use_top.astype(np.float64)) @ A_top + scipy.sparse.diags(use_bottom.astype(np.float64)) @ A_bottom
+    A = scipy.sparse.csr_matrix(A)
+    A.eliminate_zeros()
+    return A
+
+
+def write_weights(A, path, attrs={}):
+    ''' Write a sparse weight matrix in the xesmf file format (S, row, col; 1-based),
+    so the file can also be passed to xesmf with reuse_weights=True.'''
+    A = scipy.sparse.coo_matrix(A)
+    ds = xr.Dataset({'S': ('n_s', A.data.astype(np.float64)),
+                     'row': ('n_s', (A.row + 1).astype(np.int32)),
+                     'col': ('n_s', (A.col + 1).astype(np.int32))})
+    ds.attrs = dict(attrs)
+    ds.attrs['n_out'] = A.shape[0]
+    ds.attrs['n_in'] = A.shape[1]
+    ds.to_netcdf(path)
+
+
+def read_weights(path, shape=None):
+    ''' Read a weight file (xesmf format) into a CSR matrix. shape is (n_out, n_in), from attrs if missing.'''
+    with xr.open_dataset(path) as ds:
+        ds.load()
+    if shape is None:
+        shape = (int(ds.attrs['n_out']), int(ds.attrs['n_in']))
+    return scipy.sparse.csr_matrix((ds.S.values, (ds.row.values - 1, ds.col.values - 1)), shape=shape)
+
+
+def normalize_weights(A, mask_in=None, min_frac=0.):
+    ''' Make weights mask aware: columns of invalid source cells (mask_in False) are removed and each
+    row is renormalized by the weight of its valid source cells, so target values are means over
+    valid cells only. Rows with no valid source (or less than min_frac of their weight) are left empty.'''
+    A = scipy.sparse.csr_matrix(A, dtype=np.float64)
+    total = np.asarray(A.sum(axis=1)).ravel()
+    if mask_in is not None:
+        valid = np.asarray(mask_in).ravel().astype(np.float64)
+        A = A @ scipy.sparse.diags(valid)
+    valid_sum = np.asarray(A.sum(axis=1)).ravel()
+    keep = (valid_sum > 0) & (valid_sum >= min_frac*total)
+    scale = np.zeros(valid_sum.size)
+    scale[keep] = 1./valid_sum[keep]
+    A = scipy.sparse.csr_matrix(scipy.sparse.diags(scale) @ A)
+    A.eliminate_zeros()
+    return A
+
+
+def fold_land_fraction(A, land_frac=None, threshold=1., renormalize=False):
+    ''' Fold the land fraction of source cells into weights, as multiplying fields by
+    (1 - land_frac.where(land_frac < threshold)) before regridding: columns are scaled by the ocean
+    fraction, and rows using any cell with land_frac >= threshold are left empty (NaN when applied).
+    If renormalize, those cells are instead dropped and rows renormalized (see normalize_weights).'''
+    land_frac = np.asarray(land_frac, dtype=np.float64).ravel()
+    valid = land_frac < threshold
+    A = scipy.sparse.csr_matrix(A, dtype=np.float64)
+    if renormalize:
+        A = normalize_weights(A, mask_in=valid)
+    else:
+        A.eliminate_zeros()
+        uses_masked = (A @ (~valid).astype(np.float64)) != 0
+        A = scipy.sparse.diags((~uses_masked).astype(np.float64)) @ A
+    A = scipy.sparse.csr_matrix(A @ scipy.sparse.diags(np.where(valid, 1. - land_frac, 0.)))
+    A.eliminate_zeros()
+    return A
+
+
+def empty_rows(A):
+    ''' Boolean array of target cells (rows) without any weight.'''
+    return np.diff(scipy.sparse.csr_matrix(A).indptr) == 0
+
+
+def _lock_token():
+    ''' Unique token of a build lock: host, pid and a random part (one per lock taken).'''
+    return socket.gethostname()+':'+str(os.getpid())+':'+uuid.uuid4().hex
+
+
+def _create_lock(lock, token):
+    ''' Atomically create lock holding token, returns False if it already exists.'''
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return True
+
+
+def _read_lock(lock):
+    ''' Token in lock, None if there is no lock.'''
+    try:
+        with open(lock) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+class WeightCache(object):
+    """ Disk cache of regridding weights shared across runs, models and processes.
+
+    Weights are keyed by a hash of the source grid (centers, bounds, mask), the target grid,
+    the method and any extra options, so a grid that is seen again (i.e. every file of a model)
+    never rebuilds its weights. Files are validated on load and the least recently used are
+    removed once the cache is larger than max_bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=5*1024**3, lock_timeout=3600):
+        """"""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout # seconds before a build lock is considered stale
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, ds_in, ds_out, method, **kwargs):
+        h = hashlib.sha1()
+        for part in [grid_hash(ds_in), grid_hash(ds_out), method] + [k+'='+str(kwargs[k]) for k in sorted(kwargs)]:
+            h.update(part.encode())
+        return method+'_'+h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key+'.nc')
+
+    def validate(self, path, shape):
+        ''' Return the weights in path if the file is complete and matches shape, else None.'''
+        try:
+            A = read_weights(path)
+        except Exception:
+            return None
+        if (A.shape != tuple(shape)) or not np.isfinite(A.data).all():
+            return None
+        return A
+
+    def get(self, ds_in, ds_out, method, builder=None, **kwargs):
+        ''' Return the (n_out x n_in) CSR weights, built (by builder or xesmf) only if not cached.
+        builder(ds_in, ds_out, method, **kwargs) must return a scipy sparse matrix.'''
+        key = self.key(ds_in, ds_out, method, **kwargs)
+        path = self.path(key)
+        shape = (int(np.prod(grid_shape(ds_out))), int(np.prod(grid_shape(ds_in))))
+
+        if os.path.exists(path):
+            A = self.validate(path, shape)
+            if A is not None:
+                try:
+                    os.utime(path) # Mark as recently used
+                except FileNotFoundError: # Evicted by another process meanwhile
+                    pass
+                return A
+            print('Removing invalid cached weights', path)
+            try:
+                os.remove(path)
+            except FileNotFoundError: # Removed by another process meanwhile
+                pass
+
+        # Only one process builds a given set of weights, the others wait for it
+        lock = path+'.lock'
+        token = _lock_token()
+        while not self._lock(lock, token):
+            A = self._wait_for(path, lock, shape)
+            if A is not None:
+                return A
+            # The other process gave up (failed or died) without weights, try to build them here
+        try:
+            if builder is None:
+                builder = default_builder(method)
+            start_time = time.time()
+            A = scipy.sparse.csr_matrix(builder(ds_in, ds_out, method, **kwargs))
+            if A.shape != shape:
+                raise ValueError('Weights built have shape '+str(A.shape)+', expected '+str(shape))
+
+            # Write to a temporary file, then move it in place (other processes never see a partial file)
+            (fd, tmp_path) = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            os.close(fd)
+            write_weights(A, tmp_path, attrs={'method': method, 'key': key,
+                                              'build_seconds': time.time() - start_time})
+            os.replace(tmp_path, path)
+        finally:
+            self._unlock(lock, token)
+        self.evict(keep=path)
+        return A
+
+    def get_normalized(self, ds_in, ds_out, method, mask_in=None, builder=None, min_frac=0., **kwargs):
+        ''' Return mask aware, renormalized weights (see normalize_weights), cached under a key that
+        includes the source mask (mask_in, or the mask variable of ds_in; True is valid).
+        The unmasked weights are cached too, so a new mask does not rebuild them.'''
+        if mask_in is None:
+            mask_in = ds_in['mask'] if 'mask' in ds_in.variables else None
+        ds_base = ds_in.drop_vars('mask', errors='ignore')
+        ds_grid = ds_base
+        if mask_in is not None:
+            mask_in = np.asarray(mask_in).astype(bool).reshape(grid_shape(ds_grid))
+            ds_grid = ds_grid.assign(mask=(grid_dims(ds_grid), mask_in))
+
+        def build_normalized(*args, **kw):
+            # Base weights are only read (or built) when the normalized ones are not cached
+            A = self.get(ds_base, ds_out, method, builder=builder, **kwargs)
+            return normalize_weights(A, mask_in, min_frac)
+        return self.get(ds_grid, ds_out, method, builder=build_normalized, normalized=True, min_frac=min_frac,
+                        **kwargs)
+
+    def get_land_masked(self, ds_in, ds_out, method, land_frac=None, threshold=1., renormalize=False, builder=None,
+                        **kwargs):
+        ''' Return weights with the land fraction (0 to 1) of the source grid folded in (see
+        fold_land_fraction), cached under a key that includes land_frac, threshold and renormalize.
+        The weights without land fraction are cached too, and reused for other thresholds.'''
+        ds_base = ds_in.drop_vars(['mask', 'land_frac'], errors='ignore')
+        land_frac = np.asarray(land_frac, dtype=np.float64).reshape(grid_shape(ds_base))
+        ds_grid = ds_base.assign(land_frac=(grid_dims(ds_base), land_frac))
+
+        def build_land_masked(*args, **kw):
+            # Base weights are only read (or built) when the land masked ones are not cached
+            A = self.get(ds_base, ds_out, method, builder=builder, **kwargs)
+            return fold_land_fraction(A, land_frac, threshold, renormalize)
+        return self.get(ds_grid, ds_out, method, builder=build_land_masked,
+                        land_threshold=threshold, renormalize=renormalize, **kwargs)
+
+    def _lock(self, lock, token):
+        ''' Try to take the build lock, a file holding the token of its owner. A stale lock (see
+        _is_stale) is first moved away under a name only this process uses, so of several processes
+        taking it over only one removes it, and the lock is then created again with O_EXCL.'''
+        if _create_lock(lock, token):
+            return True
+        stale_token = _read_lock(lock)
+        if (stale_token is None) or not self._is_stale(lock, stale_token):
+            return False
+        grave = lock+'.'+token.replace(':', '_')+'.stale'
+        try:
+            os.rename(lock, grave)
+        except FileNotFoundError:
+            return False # Taken over by another process
+        if _read_lock(grave) != stale_token:
+            # Moved the new lock of another process, put it back (os.link never replaces a lock created since)
+            try:
+                os.link(grave, lock)
+            except FileExistsError:
+                pass
+            os.remove(grave)
+            return False
+        os.remove(grave)
+        return _create_lock(lock, token)
+
+    def _unlock(self, lock, token):
+        ''' Remove the build lock, only if this process still owns it.'''
+        if _read_lock(lock) == token:
+            os.remove(lock)
+
+    def _is_stale(self, lock, token):
+        ''' A lock is stale if older than lock_timeout, or if its owner was a process of this host that died.'''
+        try:
+            if time.time() - os.path.getmtime(lock) > self.lock_timeout:
+                return True
+        except FileNotFoundError:
+            return False
+        parts = token.split(':')
+        if (len(parts) != 3) or (parts[0] != socket.gethostname()):
+            return False
+        try:
+            os.kill(int(parts[1]), 0)
+        except ProcessLookupError:
+            return True
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def _wait_for(self, path, lock, shape, poll=1):
+        ''' Wait for another process to finish building path, returns None if it gave up.'''
+        while True:
+            token = _read_lock(lock)
+            if (token is None) or self._is_stale(lock, token):
+                break
+            time.sleep(poll)
+        if os.path.exists(path):
+            return self.validate(path, shape)
+        return None
+
+    def regridder(self, ds_in, ds_out, method, builder=None, **kwargs):
+        ''' Return a xesmf Regridder that reads its weights from the cache.'''
+        import xesmf as xe
+        self.get(ds_in, ds_out, method, builder=builder, **kwargs)
+        return xe.Regridder(ds_in, ds_out, method, filename=self.path(self.key(ds_in, ds_out, method, **kwargs)),
+                            reuse_weights=True, **kwargs)
+
+    def _files(self):
+        ''' (mtime, size, path) of the weight files, skipping files removed by another process meanwhile.'''
+        files = []
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith('.nc'):
+                continue
+            path = os.path.join(self.cache_dir, f)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def size(self):
+        return sum(x[1] for x in self._files())
+
+    def evict(self, keep=None):
+        ''' Remove least recently used weight files until the cache fits in max_bytes.'''
+        files = sorted(self._files())
+        total = sum(x[1] for x in files)
+        for (mtime, size, f) in files:
+            if total <= self.max_bytes:
+                break
+            if f == keep:
+                continue
+            total = total - size
+            try:
+                os.remove(f)
+            except FileNotFoundError: # Evicted by another process meanwhile
+                pass
+
+
+# Clean up applied after regridding, per variable (missing keys are not applied)
+# min/max: clamp values (NaN stay NaN), fill: value of NaN cells that are not land
+SIPN_VAR_RULES = {'sic': {'min': 0., 'max': 1.},
+                  'hi': {'min': 0.}}
+
+
+def _clean_block(out, min=None, max=None, fill=None, land_mask=None):
+    ''' Apply clean up rules in place to out (..., y, x), land_mask (y, x) True is set to NaN.'''
+    if (min is not None) or (max is not None):
+        np.clip(out, min, max, out=out)
+    if fill is not None:
+        is_fill = np.isnan(out)
+        if land_mask is not None:
+            is_fill &= ~land_mask
+        out[is_fill] = fill
+    if land_mask is not None:
+        out[..., land_mask] = np.nan
+    return out
+
+
+def _clean_kernel(data, land_mask=None, dtype=np.float32, **rule):
+    # One copy per block, then all rules in place
+    return _clean_block(np.array(data, dtype=dtype), land_mask=land_mask, **rule)
+
+
+def clean_fields(ds, rules=SIPN_VAR_RULES, land_mask=None, spatial_dims=('y', 'x'), dtype=np.float32, expand=True):
+    ''' Post regrid clean up of all variables of ds in a single pass per block (works on dask):
+    bounds and fill from rules (see SIPN_VAR_RULES), land (land_mask True) set to NaN, then
+    expand_to_sipn_dims (if expand).'''
+    from . import import_data
+    if land_mask is not None:
+        land_mask = np.asarray(land_mask).astype(bool)
+    ds_out = ds.copy()
+    for cvar in ds.data_vars:
+        rule = rules.get(cvar, {})
+        if not rule and land_mask is None:
+            continue
+        if not set(spatial_dims).issubset(ds[cvar].dims):
+            continue
+        ds_out[cvar] = xr.apply_ufunc(_clean_kernel, ds[cvar], input_core_dims=[list(spatial_dims)],
+                                      output_core_dims=[list(spatial_dims)],
+                                      kwargs=dict(rule, land_mask=land_mask, dtype=dtype),
+                                      dask='parallelized', output_dtypes=[dtype],
+                                      keep_attrs=True).transpose(*ds[cvar].dims)
+    if expand:
+        ds_out = import_data.expand_to_sipn_dims(ds_out)
+    return ds_out
+
+
+def _apply_weights_block(data, A=None, out_shape=None, block_size=None, dtype=np.float32, nan_rows=None,
+                         rule=None, land_mask=None):
+    ''' numpy kernel: (..., n_in) fields -> (..., n_out), one CSR x dense product per block of fields.'''
+    lead = data.shape[:-2]
+    X = data.reshape(-1, A.shape[1])
+    out = np.empty((X.shape[0], A.shape[0]), dtype=dtype)
+    for i_start in range(0, X.shape[0], block_size):
+        X_block = np.ascontiguousarray(X[i_start:i_start+block_size].T, dtype=dtype) # (n_in, n_block)
+        out[i_start:i_start+block_size] = (A @ X_block).T
+    if nan_rows is not None:
+        out[:, nan_rows] = np.nan
+    out = out.reshape(lead + tuple(out_shape))
+    if rule or (land_mask is not None): # Fused clean up, on the output block
+        _clean_block(out, land_mask=land_mask, **(rule or {}))
+    return out
+
+
+def get_target_cells(ds_out, ds_region=None, lat_min=None):
+    ''' Flat indices of the target cells worth regridding: ocean cells of the region mask
+    (ds_region, i.e. sio_2016_mask_Update.nc) and/or cells north of lat_min.'''
+    (lat, lon) = grid_lat_lon(ds_out)
+    keep = np.ones(lat.size, dtype=bool)
+    if ds_region is not None:
+        keep &= ds_region.mask.isin(ds_region.ocean_regions).values.ravel()
+    if lat_min is not None:
+        keep &= lat.ravel() >= lat_min
+    return np.flatnonzero(keep)
+
+
+def _scatter_block(data, cells=None, grid_shape=None):
+    out = np.full(data.shape[:-1] + (int(np.prod(grid_shape)),), np.nan, dtype=data.dtype)
+    out[..., cells] = data
+    return out.reshape(data.shape[:-1] + tuple(grid_shape))
+
+
+class Regridder(object):
+    """ Applies sparse regridding weights (i.e. from WeightCache) to DataArrays and Datasets.
+
+    All fields (ensemble x init_time x fore_time ...) are flattened and regridded in blocks of
+    block_size fields by a single float32 CSR x dense product. Works on dask arrays (chunked along
+    any non spatial dim), the two spatial dims of the input are regridded to out_dims.
+    Target cells without weights (outside the source grid or only masked sources) are NaN
+    if nan_empty, so no NaN need to be written into the weights. Optionally the clean up rules
+    (see clean_fields) and a target land_mask are applied to each block as it is regridded.
+    If cells (flat indices of target cells, see get_target_cells) are given, only those cells are
+    regridded, to a compressed cell dim, and scatter() puts them back on the 2D target grid.
+    """
+
+    def __init__(self, A=None, ds_out=None, in_dims=None, out_dims=('y', 'x'), block_size=1024, dtype=np.float32,
+                 nan_empty=True, rules=None, land_mask=None, cells=None):
+        """"""
+        self.rules = rules or {}
+        self.dtype = np.dtype(dtype)
+        self.A = scipy.sparse.csr_matrix(A).astype(self.dtype)
+        self.ds_out = ds_out
+        self.grid_shape = tuple(int(x) for x in grid_shape(ds_out))
+        self.grid_dims = tuple(out_dims)
+        if int(np.prod(self.grid_shape)) != self.A.shape[0]:
+            raise ValueError('Weights do not match target grid size.')
+        (lat, lon) = grid_lat_lon(ds_out)
+        self.land_mask = None if land_mask is None else np.asarray(land_mask).astype(bool)
+
+        self.cells = cells
+        if cells is None:
+            self.out_dims = self.grid_dims
+            self.out_shape = self.grid_shape
+            self.out_coords = {'lat': (self.out_dims, lat.reshape(self.out_shape)),
+                               'lon': (self.out_dims, lon.reshape(self.out_shape))}
+        else: # Compressed target, keep only the rows of cells
+            self.cells = np.asarray(cells)
+            self.A = self.A[self.cells]
+            self.out_dims = ('cell',)
+            self.out_shape = (self.cells.size,)
+            self.out_coords = {'cell': self.cells, 'lat': ('cell', lat.ravel()[self.cells]),
+                               'lon': ('cell', lon.ravel()[self.cells])}
+            if self.land_mask is not None:
+                self.land_mask = self.land_mask.ravel()[self.cells]
+        self.in_dims = in_dims
+        self.block_size = block_size
+        self.nan_rows = np.flatnonzero(empty_rows(self.A)) if nan_empty else None
+
+    @classmethod
+    def from_cache(cls, cache, ds_in, ds_out, method, builder=None, in_dims=None, out_dims=('y', 'x'),
+                   block_size=1024, dtype=np.float32, mask_in=None, rules=None, land_mask=None, cells=None,
+                   land_frac=None, threshold=1., renormalize=False, **kwargs):
+        ''' Regridder with weights from a WeightCache, with the source land fraction folded in if
+        land_frac is given, else mask aware (normalized) if mask_in is given or ds_in has a mask variable.
+        in_dims defaults to the spatial dims of ds_in, so inputs in any dim order are regridded correctly.'''
+        if land_frac is not None:
+            A = cache.get_land_masked(ds_in, ds_out, method, land_frac=land_frac, threshold=threshold,
+                                      renormalize=renormalize, builder=builder, **kwargs)
+        elif (mask_in is not None) or ('mask' in ds_in.variables):
+            A = cache.get_normalized(ds_in, ds_out, method, mask_in=mask_in, builder=builder, **kwargs)
+        else:
+            A = cache.get(ds_in, ds_out, method, builder=builder, **kwargs)
+        if in_dims is None:
+            in_dims = grid_dims(ds_in)
+        return cls(A=A, ds_out=ds_out, in_dims=in_dims, out_dims=out_dims, block_size=block_size, dtype=dtype,
+                   rules=rules, land_mask=land_mask, cells=cells)
+
+    def _regrid_dataarray(self, da):
+        in_dims = list(self.in_dims) if self.in_dims else list(da.dims[-2:])
+        if not set(in_dims).issubset(da.dims):
+            raise ValueError('Source grid dims '+str(in_dims)+' not found in '+str(da.dims)+', set in_dims.')
+        if da.chunks is not None:
+            da = da.chunk({d: -1 for d in in_dims}) # Spatial dims must be one chunk
+        da_out = xr.apply_ufunc(_apply_weights_block, da,
+                                input_core_dims=[in_dims], output_core_dims=[list(self.out_dims)],
+                                exclude_dims=set(in_dims),
+                                kwargs={'A': self.A, 'out_shape': self.out_shape,
+                                        'block_size': self.block_size, 'dtype': self.dtype,
+                                        'nan_rows': self.nan_rows, 'land_mask': self.land_mask,
+                                        'rule': self.rules.get(da.name, {})},
+                                dask='parallelized', output_dtypes=[self.dtype],
+                                dask_gufunc_kwargs={'output_sizes': dict(zip(self.out_dims, self.out_shape))},
+                                keep_attrs=True)
+        # Drop input grid coords, add target lat/lon
+        da_out = da_out.drop_vars([x for x in da_out.coords if set(da[x].dims) & set(in_dims)], errors='ignore')
+        return da_out.assign_coords(self.out_coords)
+
+    def __call__(self, obj):
+        if isinstance(obj, xr.DataArray):
+            return self._regrid_dataarray(obj)
+        in_dims = list(self.in_dims) if self.in_dims else None
+        ds_out = xr.Dataset()
+        for cvar in obj.data_vars:
+            c_dims = in_dims or list(obj[cvar].dims[-2:])
+            if set(c_dims).issubset(obj[cvar].dims):
+                ds_out[cvar] = self._regrid_dataarray(obj[cvar])
+        return ds_out
+
+    def _scatter_dataarray(self, da):
+        (lat, lon) = grid_lat_lon(self.ds_out)
+        da_out = xr.apply_ufunc(_scatter_block, da.drop_vars(['cell', 'lat', 'lon'], errors='ignore'),
+                                input_core_dims=[['cell']], output_core_dims=[list(self.grid_dims)],
+                                exclude_dims={'cell'},
+                                kwargs={'cells': self.cells, 'grid_shape': self.grid_shape},
+                                dask='parallelized', output_dtypes=[da.dtype],
+                                dask_gufunc_kwargs={'output_sizes': dict(zip(self.grid_dims, self.grid_shape))},
+                                keep_attrs=True)
+        return da_out.assign_coords({'lat': (self.grid_dims, lat.reshape(self.grid_shape)),
+                                     'lon': (self.grid_dims, lon.reshape(self.grid_shape))})
+
+    def scatter(self, obj):
+        ''' Put compressed (cell) output back on the 2D target grid, NaN outside the cells.'''
+        if self.cells is None:
+            return obj
+        if isinstance(obj, xr.DataArray):
+            return self._scatter_dataarray(obj)
+        ds_out = obj.drop_vars([x for x in obj.data_vars if 'cell' in obj[x].dims] + ['cell', 'lat', 'lon'],
+                               errors='ignore')
+        for cvar in obj.data_vars:
+            if 'cell' in obj[cvar].dims:
+                ds_out[cvar] = self._scatter_dataarray(obj[cvar])
+        return ds_out
+
+
+_worker_setup = {} # (setup, model) -> object of the model currently used by this worker process
+
+
+def _get_worker_setup(setup, model):
+    ''' Build (once per worker per model) the object setup(model) returns, i.e. a Regridder with its
+    weights loaded. Only the last model is kept, tasks are sorted by model.'''
+    key = (setup, model)
+    if key not in _worker_setup:
+        _worker_setup.clear()
+        _worker_setup[key] = setup(model)
+    return _worker_setup[key]
+
+
+def _run_regrid_task(regrid_file, setup, task):
+    ''' Run one task in a worker, never raises (errors are returned in the result).'''
+    result = dict(task, status='done', error=None, pid=os.getpid())
+    start_time = time.time()
+    try:
+        regridder = _get_worker_setup(setup, task.get('model')) if setup else None
+        result['setup_seconds'] = time.time() - start_time
+        regrid_file(regridder=regridder, **task)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - start_time
+    return result
+
+
+def available_memory():
+    ''' Available physical memory in bytes (Linux), None if unknown.'''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_n_workers(tasks, mem_budget=None, mem_per_task=None, mem_factor=10, n_workers=None):
+    ''' Number of worker processes that fit in mem_budget (default half of the available memory).
+    mem_per_task defaults to mem_factor times the largest input file.'''
+    n_cpu = n_workers or os.cpu_count() or 1
+    if mem_budget is None:
+        mem = available_memory()
+        mem_budget = mem / 2 if mem else None
+    if mem_per_task is None:
+        sizes = [os.path.getsize(t['in_file']) for t in tasks if os.path.exists(t.get('in_file', ''))]
+        mem_per_task = mem_factor * max(sizes) if sizes else None
+    if not mem_budget or not mem_per_task:
+        return n_cpu
+    return int(max(1, min(n_cpu, len(tasks), mem_budget // mem_per_task)))
+
+
+def _run_pool(tasks, regrid_file, setup, n_workers):
+    ''' Run tasks on a new process pool, at most n_workers at a time, until done or a worker dies.
+    Returns (results, in_flight, not_started): results of the tasks that completed, tasks that were
+    submitted when the pool broke and tasks that were never submitted.'''
+    tasks = list(tasks)
+    results = []
+    running = {}
+    # spawn (not fork), forking a process that already runs dask threads can deadlock
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        try:
+            while tasks or running:
+                # Only n_workers tasks are submitted at once, so a broken pool only loses those,
+                # and a task is only removed from tasks once submitted
+                while tasks and (len(running) < n_workers):
+                    running[pool.submit(_run_regrid_task, regrid_file, setup, tasks[0])] = tasks[0]
+                    tasks.pop(0)
+                (done, _) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                broken = False
+                for f in done:
+                    try:
+                        results.append(f.result())
+                    except concurrent.futures.process.BrokenProcessPool:
+                        broken = True
+                        continue
+                    except Exception as e: # i.e. the task could not be sent to the worker
+                        results.append(dict(running[f], status='failed', error=repr(e), seconds=None, pid=None))
+                    del running[f]
+                if broken:
+                    break
+        except concurrent.futures.process.BrokenProcessPool: # Broke while submitting
+            pass
+    return (results, list(running.values()), tasks)
+
+
+def run_regrid(tasks=None, regrid_file=None, setup=None, n_workers=None, mem_budget=None, mem_per_task=None,
+               catalog=None, stage='regrid'):
+    ''' Regrid many native files across a process pool.
+    ----------
+    Parameters:
+    tasks : List
+        One dict per file, with at least model and in_file (i.e. also out_file), passed as keywords to regrid_file
+    regrid_file : function
+        regrid_file(regridder=None, **task), regrids one file (must be importable, it is sent to workers)
+    setup : function
+        (optional) setup(model), i.e. loads the cached weights of a model, run once per worker per model
+    n_workers : int
+        Max number of worker processes (default is number of cpus), reduced to fit mem_budget
+    mem_budget : float
+        Bytes the workers may use together (default half of the available memory)
+    mem_per_task : float
+        Bytes used by one task (default 10 times the largest in_file)
+    catalog : FileCatalog
+        (optional) in_file of each task is marked done/failed for stage
+
+    Returns:
+    results = List
+        One dict per task (task keys plus status, error, seconds, setup_seconds, pid)
+    '''
+    tasks = sorted(tasks, key=lambda t: (str(t.get('model')), t['in_file'])) # Same model follows on a worker
+    if not tasks:
+        return []
+    n_workers = get_n_workers(tasks, mem_budget=mem_budget, mem_per_task=mem_per_task, n_workers=n_workers)
+
+    start_time = time.time()
+    results = []
+    n_tasks = len(tasks)
+    while tasks:
+        (c_results, in_flight, tasks) = _run_pool(tasks, regrid_file, setup, n_workers)
+        results.extend(c_results)
+        # A worker died (i.e. crash in a C library): run each task it may have been running alone,
+        # so only the task(s) that crash are failed, then go on with the rest in a new pool
+        for task in in_flight:
+            (c_results, crashed, _) = _run_pool([task], regrid_file, setup, 1)
+            results.extend(c_results)
+            results.extend(dict(t, status='failed', error='Worker process died', seconds=None, pid=None)
+                           for t in crashed)
+    elapsed = time.time() - start_time
+
+    for result in results:
+        if result['status'] == 'failed':
+            print('Failed', result['in_file'], result['error'].strip().splitlines()[-1])
+    n_done = sum(r['status'] == 'done' for r in results)
+    print('Regridded', n_done, 'of', n_tasks, 'files in', round(elapsed, 1), 'seconds with', n_workers, 'workers.')
+    if catalog is not None:
+        for status in ['done', 'failed']:
+            catalog.mark([r['in_file'] for r in results if r['status'] == status], stage=stage, status=status)
+    return results
@@ -27,6 +27,7 @@ import glob
 import datetime
 
 from esio import EsioData as ed
+from esio import obs_store
 
 import dask
 # from dask.distributed import Client
@@ -48,7 +49,7 @@ E = ed.EsioData.load()
 data_dir = E.obs_dir
 
 # Flags
-UpdateAll = False
+UpdateAll = False # Rewrite all years (i.e. to re-encode existing files compactly)
 
 # Products to import
 product_list = ['NSIDC_0081', 'NSIDC_0079', 'NSIDC_0051']
@@ -69,8 +70,8 @@ for c_product in product_list:
                 os.makedirs(out_dir)
                 
         nc_out = os.path.join(out_dir, cyear_str+'.nc')
-        # Don't update file if exits, unless current year
-        if (os.path.isfile(nc_out)) & (cyear!=cy):
+        # Don't update file if exits, unless current year (or UpdateAll)
+        if (os.path.isfile(nc_out)) & (cyear!=cy) & (not UpdateAll):
             #print("File already exists")
             continue
 
@@ -83,7 +84,8 @@ for c_product in product_list:
                                       concat_dim='time', autoclose=True, parallel=True)
 
         
-        ds_year.to_netcdf(nc_out)
+        # Compact encoding (packed sic, compressed), see obs_store.write_obs
+        obs_store.write_obs(ds_year, nc_out, product=c_product)
         print(cyear)
       
     # For each Product
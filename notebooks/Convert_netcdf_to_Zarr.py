@@ -33,6 +33,7 @@ import datetime
 from esio import EsioData as ed
 from esio import ice_plot
 from esio import import_data
+from esio import obs_store
 import dask
 from dask.distributed import Client
 import timeit
@@ -60,8 +61,14 @@ for c_product in product_list:
                               concat_dim='time', autoclose=True, parallel=True)
     ds = ds.chunk({'time':1}) # Bug in Zarr, remove once fixed (https://github.com/pydata/xarray/pull/2487)
 
-    # Save to Zarr file
-    ds.to_zarr(os.path.join(obs_dir,'zarr',c_product), 'w')
+    # Save to Zarr file, with the compact encoding (packed sic, compressed)
+    map_store = obs_store.get_obs_store_path(E, c_product)
+    obs_store.write_obs(ds, map_store, product=c_product)
+
+    # Add the new days to the time-series copy (for per pixel access)
+    obs_store.sync_timeseries_store(obs_store.open_obs(map_store),
+                                    obs_store.get_obs_store_path(E, c_product, layout='timeseries'),
+                                    product=c_product)
     
     print("Done with",c_product)
 
@@ -0,0 +1,207 @@
+'''
+
+This code is part of the SIPN2 project focused on improving sub-seasonal to seasonal predictions of Arctic Sea Ice.
+If you use this code for a publication or presentation, please cite the reference in the README.md on the
+main page (https://github.com/NicWayand/ESIO).
+
+GNU General Public License v3.0
+
+Benchmark of regridding methods from synthetic source grids shaped like the model grids we import
+(GFDL tripolar, RASM rotated pole, 1 degree S2S and NESM tripolar) to the NSIDC 25 km grid.
+For each grid and method reports: weight build time, apply time per field, peak memory (max resident set
+size, so memory allocated by ESMF is included) and error against an analytic field. Each case runs in a
+new process, so its peaks are not those of a previous case. nearest_s2d is built by the esio KD-tree,
+nearest_s2d_xesmf by xesmf. Methods that need xesmf are skipped if it is not installed.
+
+Usage: python benchmark_regrid.py [--grids GFDL S2S] [--methods nearest_s2d nearest_s2d_xesmf bilinear] [--scale 0.5] [--csv out.csv]
+
+'''
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from esio import import_data
+from esio import regrid
+
+
+# name: (kind, (nj, ni)) of the synthetic source grids
+SOURCE_GRIDS = {'GFDL': ('tripolar', (200, 360)),
+                'RASM': ('rotated_pole', (1100, 1300)),
+                'S2S': ('regular', (181, 360)),
+                'NESM': ('tripolar', (292, 362))}
+METHODS = ['nearest_s2d', 'nearest_s2d_xesmf', 'bilinear', 'conservative']
+XESMF_METHODS = ['nearest_s2d_xesmf', 'bilinear', 'conservative', 'patch', 'nearest_d2s']
+
+
+def _tripolar_lat_lon(j, i, nj, ni, lat_join=65.):
+    ''' lat/lon of (fractional) indices of a tripolar grid: regular south of lat_join,
+    a bipolar cap (poles on land at lat_join, lon 0 and 180) north of it.'''
+    j_join = nj * 0.7 # rows of the regular part
+    lon = -180. + 360. * i / ni
+    lat = np.where(j <= j_join, -80. + (lat_join + 80.) * j / j_join, lat_join)
+    # Cap on the polar stereographic plane, squeezed in Y towards the line between the two poles
+    r_join = np.tan(np.deg2rad(90. - lat_join) / 2)
+    s = np.clip((nj - j) / (nj - j_join), 0, 1)
+    X = r_join * np.cos(np.deg2rad(lon))
+    Y = r_join * np.sin(np.deg2rad(lon)) * s
+    is_cap = j > j_join
+    lat = np.where(is_cap, 90. - np.rad2deg(2 * np.arctan(np.sqrt(X**2 + Y**2))), lat)
+    lon = np.where(is_cap, np.rad2deg(np.arctan2(Y, X)), lon)
+    return (lat, lon)
+
+
+def _rotated_pole_lat_lon(j, i, nj, ni, pole_lat=15., pole_lon=-65., extent=45.):
+    ''' lat/lon of (fractional) indices of a regular grid in rotated coords (i.e. RASM, centered on the pole).'''
+    rlat = np.deg2rad(-extent + 2 * extent * j / nj)
+    rlon = np.deg2rad(-extent + 2 * extent * i / ni)
+    p_lat = np.deg2rad(pole_lat)
+    lat = np.arcsin(np.sin(rlat) * np.sin(p_lat) + np.cos(rlat) * np.cos(rlon) * np.cos(p_lat))
+    lon = np.deg2rad(pole_lon) + np.arctan2(np.cos(rlat) * np.sin(rlon),
+                                            np.sin(p_lat) * np.cos(rlat) * np.cos(rlon) - np.sin(rlat) * np.cos(p_lat))
+    return (np.rad2deg(lat), ((np.rad2deg(lon) + 180.) % 360.) - 180.)
+
+
+def _regular_lat_lon(j, i, nj, ni):
+    return (-90. + 180. * j / (nj - 1), -180. + 360. * i / ni)
+
+
+def make_source_grid(kind=None, shape=None):
+    ''' Synthetic source grid (lat, lon and lat_b, lon_b bounds on nj, ni) of a kind and shape.'''
+    f = {'tripolar': _tripolar_lat_lon, 'rotated_pole': _rotated_pole_lat_lon, 'regular': _regular_lat_lon}[kind]
+    (nj, ni) = shape
+    (i, j) = np.meshgrid(np.arange(ni) + 0.5, np.arange(nj) + 0.5)
+    (i_b, j_b) = np.meshgrid(np.arange(ni + 1), np.arange(nj + 1))
+    if kind == 'regular': # Centers on the poles
+        (i, j) = np.meshgrid(np.arange(ni), np.arange(nj))
+        (i_b, j_b) = (i_b - 0.5, np.clip(j_b - 0.5, 0, nj - 1))
+    (lat, lon) = f(j, i, nj, ni)
+    (lat_b, lon_b) = f(j_b, i_b, nj, ni)
+    return xr.Dataset(coords={'lat': (('nj', 'ni'), lat), 'lon': (('nj', 'ni'), lon),
+                              'lat_b': (('nj_b', 'ni_b'), lat_b), 'lon_b': (('nj_b', 'ni_b'), lon_b)})
+
+
+def make_NSIDC_grid():
+    ''' NSIDC 25 km polar stereographic grid (spherical earth, true at 70N, central lon -45).'''
+    (xm, ym) = import_data.get_NSIDC_xm_ym()
+    R = 6371228.
+    def lat_lon(x, y):
+        rho = np.sqrt(x**2 + y**2)
+        lat = 90. - np.rad2deg(2 * np.arctan(rho / (R * (1 + np.sin(np.deg2rad(70.))))))
+        lon = -45. + np.rad2deg(np.arctan2(x, -y))
+        return (lat, ((lon + 180.) % 360.) - 180.)
+    (x, y) = np.meshgrid(xm.values + 12500., ym.values - 12500.)
+    (x_b, y_b) = np.meshgrid(np.append(xm.values, xm.values[-1] + 25000.), np.append(ym.values, ym.values[-1] - 25000.))
+    (lat, lon) = lat_lon(x, y)
+    (lat_b, lon_b) = lat_lon(x_b, y_b)
+    return xr.Dataset(coords={'lat': (('nj', 'ni'), lat), 'lon': (('nj', 'ni'), lon),
+                              'lat_b': (('nj_b', 'ni_b'), lat_b), 'lon_b': (('nj_b', 'ni_b'), lon_b)})
+
+
+def analytic_field(lat, lon):
+    ''' Smooth test field (also at the pole), so the error of each method can be measured at the target cells.'''
+    (x, y, z) = regrid.lat_lon_to_xyz(lat, lon).T.reshape((3,) + np.shape(lat))
+    return 2. + np.sin(4 * x) * y + np.cos(3 * z)
+
+
+def has_xesmf():
+    try:
+        import xesmf
+    except ImportError:
+        return False
+    return True
+
+
+def get_builder(name):
+    ''' (method, builder, builder label) of a benchmarked method name.'''
+    if name == 'nearest_s2d':
+        return ('nearest_s2d', regrid.build_nearest_weights, 'esio KD-tree')
+    method = name.replace('_xesmf', '')
+    return (method, regrid._build_xesmf_weights, 'xesmf')
+
+
+def max_rss():
+    ''' Peak resident set size of this process so far, in bytes (ru_maxrss is in KB on Linux).'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def benchmark(ds_in, ds_out, name, n_fields=20, block_size=1024):
+    ''' Build the weights of method name and regrid n_fields fields. Returns dict of results.
+    Peak memory is of the whole process, run it in a new process per case (see run_case).'''
+    (method, builder, label) = get_builder(name)
+    field = analytic_field(ds_in.lat.values, ds_in.lon.values).astype(np.float32)
+    da = xr.DataArray(np.broadcast_to(field, (n_fields,) + field.shape), dims=('fore_time', 'nj', 'ni'))
+    base_rss = max_rss()
+
+    start_time = time.time()
+    A = builder(ds_in, ds_out, method)
+    build_seconds = time.time() - start_time
+    build_rss = max_rss()
+
+    regridder = regrid.Regridder(A, ds_out, block_size=block_size)
+    start_time = time.time()
+    out = regridder(da).values
+    apply_seconds = time.time() - start_time
+    apply_rss = max_rss()
+
+    expected = analytic_field(ds_out.lat.values, ds_out.lon.values)
+    error = out[0] - expected
+    valid = np.isfinite(error)
+    return {'method': method, 'builder': label, 'n_weights': A.nnz,
+            'build_s': build_seconds, 'apply_ms_per_field': 1000. * apply_seconds / n_fields,
+            'base_rss_MB': base_rss / 1024.**2, 'build_peak_rss_MB': build_rss / 1024.**2,
+            'apply_peak_rss_MB': apply_rss / 1024.**2,
+            'rmse': np.sqrt(np.mean(error[valid]**2)), 'max_abs_error': np.abs(error[valid]).max(),
+            'coverage': valid.mean()}
+
+
+def _run_case(kind, shape, name, n_fields):
+    return benchmark(make_source_grid(kind, shape), make_NSIDC_grid(), name, n_fields=n_fields)
+
+
+def run_case(kind, shape, name, n_fields=20):
+    ''' Run benchmark in a new (spawned) process, so its peak memory is only that of this case.'''
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(_run_case, kind, shape, name, n_fields).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark regridding methods on synthetic model grids.')
+    parser.add_argument('--grids', nargs='+', default=list(SOURCE_GRIDS.keys()))
+    parser.add_argument('--methods', nargs='+', default=METHODS)
+    parser.add_argument('--n-fields', type=int, default=20, help='fields regridded to time apply')
+    parser.add_argument('--scale', type=float, default=1., help='scale the source grid shapes (i.e. 0.25 for a quick run)')
+    parser.add_argument('--csv', default=None, help='also write results to this csv file')
+    args = parser.parse_args()
+
+    xesmf_found = has_xesmf()
+    results = []
+    for grid in args.grids:
+        (kind, shape) = SOURCE_GRIDS[grid]
+        shape = tuple(max(4, int(round(x * args.scale))) for x in shape)
+        for method in args.methods:
+            if (method in XESMF_METHODS) and not xesmf_found:
+                print('Skipping', method, 'for', grid, '(needs xesmf)')
+                continue
+            print('Benchmarking', grid, shape, method)
+            result = run_case(kind, shape, method, n_fields=args.n_fields)
+            results.append(dict({'grid': grid, 'shape': 'x'.join(str(x) for x in shape)}, **result))
+
+    df = pd.DataFrame(results)
+    with pd.option_context('display.width', 200, 'display.max_columns', 20, 'display.precision', 4):
+        print(df)
+    if args.csv:
+        df.to_csv(args.csv, index=False)
+
+
+if __name__ == '__main__':
+    main()
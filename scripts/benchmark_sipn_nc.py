@@ -0,0 +1,85 @@
+'''
+
+This code is part of the SIPN2 project focused on improving sub-seasonal to seasonal predictions of Arctic Sea Ice.
+If you use this code for a publication or presentation, please cite the reference in the README.md on the
+main page (https://github.com/NicWayand/ESIO).
+
+GNU General Public License v3.0
+
+Benchmark of the regridded model output (sipn_nc) writer modes: file size, write time and read time
+(full load, and the ensemble mean map of each fore_time, a typical read of the later stages)
+of a synthetic forecast on the NSIDC 25 km grid.
+
+Usage: python benchmark_sipn_nc.py [--n-ens 10] [--n-fore 46] [--out-dir /tmp]
+
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from esio import import_data
+
+
+MODES = [None, 'float32', 'uint16']
+
+
+def make_forecast(n_ens=10, n_fore=46, shape=import_data.NSIDC_SHAPE):
+    ''' Synthetic sic and hi forecast (ensemble, fore_time, y, x) with smooth fields, ice edge and land.'''
+    (ny, nx) = shape
+    (x, y) = np.meshgrid(np.linspace(-1, 1, nx), np.linspace(-1, 1, ny))
+    r = np.sqrt(x**2 + y**2)
+    rng = np.random.RandomState(0)
+    edge = 0.6 + 0.1 * rng.rand(n_ens, n_fore, 1, 1) + 0.05 * np.sin(6 * np.arctan2(y, x))
+    sic = np.clip((edge - r) * 5 + 0.02 * rng.randn(n_ens, n_fore, ny, nx), 0, 1)
+    sic[:, :, (r > 0.95) | (np.abs(x - 0.3) + np.abs(y + 0.2) < 0.1)] = np.nan # land
+    ds = xr.Dataset({'sic': (('ensemble', 'fore_time', 'y', 'x'), sic),
+                     'hi': (('ensemble', 'fore_time', 'y', 'x'), 3 * sic)})
+    ds.coords['fore_time'] = pd.to_timedelta(np.arange(n_fore), unit='D')
+    ds.coords['init_time'] = np.datetime64('2018-01-01')
+    return ds
+
+
+def benchmark(ds, f_out, mode=None):
+    start_time = time.time()
+    import_data.write_sipn_nc(ds, f_out, mode=mode)
+    write_seconds = time.time() - start_time
+
+    start_time = time.time()
+    with xr.open_dataset(f_out) as ds_in:
+        ds_in.load()
+    load_seconds = time.time() - start_time
+
+    start_time = time.time()
+    with xr.open_dataset(f_out, chunks={}) as ds_in:
+        mean = ds_in.sic.mean(dim='ensemble').compute()
+    mean_seconds = time.time() - start_time
+
+    error = np.nanmax(np.abs(mean.values.squeeze() - ds.sic.mean(dim='ensemble').values))
+    return {'mode': str(mode), 'size_MB': os.path.getsize(f_out) / 1024.**2, 'write_s': write_seconds,
+            'load_s': load_seconds, 'ens_mean_s': mean_seconds, 'max_abs_error_sic_mean': error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sipn_nc writer modes.')
+    parser.add_argument('--n-ens', type=int, default=10)
+    parser.add_argument('--n-fore', type=int, default=46)
+    parser.add_argument('--out-dir', default=None, help='where to write the test files (default a temp dir)')
+    args = parser.parse_args()
+
+    ds = make_forecast(n_ens=args.n_ens, n_fore=args.n_fore)
+    with tempfile.TemporaryDirectory(dir=args.out_dir) as tmp_dir:
+        results = [benchmark(ds, os.path.join(tmp_dir, str(mode)+'.nc'), mode=mode) for mode in MODES]
+    df = pd.DataFrame(results)
+    df['size_ratio'] = df.size_MB / df.size_MB.iloc[0]
+    with pd.option_context('display.width', 200, 'display.max_columns', 20, 'display.precision', 4):
+        print(df)
+
+
+if __name__ == '__main__':
+    main()
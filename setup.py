@@ -39,4 +39,5 @@ setup(name=DISTNAME,
       python_requires=PYTHON_REQUIRES,
       install_requires=INSTALL_REQUIRES,
       url=URL,
-      packages=PACKAGES)
+      packages=PACKAGES,
+      entry_points={'xarray.backends': ['esio_nsidc = esio.nsidc_backend:NSIDCBackendEntrypoint']})
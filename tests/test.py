@@ -5,6 +5,8 @@ from esio import metrics
 import xarray as xr
 import numpy as np
 import datetime
+import os
+import pytest
 
 # Make test model SIP data
 da_sip = xr.DataArray(np.ones((1,1,1,3)), 
@@ -31,4 +33,771 @@ def test_BSS(da_sip=da_sip, da_obs=da_obs):
     # Case Model says SIP=1 and Obs=1, BSS = 0
     BSS = metrics._BSS(mod=da_sip.isel(model=0)*0.5, 
                        obs=da_obs)
-    assert BSS.mean(dim='valid_time') == (0.5)**2
\ No newline at end of file
+    assert BSS.mean(dim='valid_time') == (0.5)**2
+
+def _write_NSIDC_binary(cfile, raw, product):
+    info = import_data.get_NSIDC_product(product)
+    with open(cfile, 'wb') as fw:
+        fw.write(b'\0' * info['header'])
+        raw.astype(info['dtype']).tofile(fw)
+
+
+def test_open_NSIDC_batch(tmpdir):
+    product = 'NSIDC_0081'
+    files = []
+    for (i, cday) in enumerate(['20180101', '20180102']):
+        raw = np.zeros(import_data.NSIDC_SHAPE, dtype=np.uint8)
+        raw[0, 0] = 125   # 50% sic
+        raw[0, 1] = 251   # pole hole
+        raw[0, 2] = 254   # land
+        raw[1, 0] = 250 * i
+        cfile = str(tmpdir.join('nt_'+cday+'_f18_nrt_n.bin'))
+        _write_NSIDC_binary(cfile, raw, product)
+        files.append(cfile)
+
+    ds = import_data.open_NSIDC_batch(files, product=product)
+    assert ds.sic.dims == ('time', 'y', 'x')
+    assert ds.sic.dtype == np.float32
+    assert ds.time.size == 2
+    assert ds.sic.isel(time=0, y=0, x=0).values == 0.5
+    assert np.isnan(ds.sic.isel(time=0, y=0, x=2).values)
+    assert ds.hole_mask.isel(time=1, y=0, x=1).values
+    assert ds.sic.isel(time=1, y=1, x=0).values == 1
+
+    # Same answer as the per-file reader
+    ds_1 = import_data.load_1_NSIDC(filein=files[1], product=product)
+    np.testing.assert_allclose(ds.sic.isel(time=1).values, ds_1.sic.values)
+
+    ds_raw = import_data.open_NSIDC_batch(files, product=product, decode=False)
+    assert ds_raw.sic.dtype == np.uint8
+
+
+def test_nsidc_backend(tmpdir):
+    product = 'NSIDC_0051'
+    files = []
+    for cday in ['19900101', '19900102']:
+        raw = np.full(import_data.NSIDC_SHAPE, 100, dtype=np.uint8)
+        raw[5, 5] = 251
+        cfile = str(tmpdir.join('nt_'+cday+'_f08_v1.1_n.bin'))
+        _write_NSIDC_binary(cfile, raw, product)
+        files.append(cfile)
+
+    ds = xr.open_mfdataset(files, engine='esio_nsidc', combine='nested', concat_dim='time')
+    assert ds.sic.dims == ('time', 'y', 'x')
+    assert ds.sic.chunks[0] == (1, 1)
+    assert ds.time.values[1] == np.datetime64('1990-01-02')
+    assert ds.hole_mask.isel(time=0, y=5, x=5).values
+    np.testing.assert_allclose(ds.sic.isel(time=0, y=0, x=0).values, 0.4)
+    assert 'xm' in ds.coords
+
+
+def _make_region():
+    (ny, nx) = import_data.NSIDC_SHAPE
+    ds_region = xr.Dataset({'mask': (('y', 'x'), np.full((ny, nx), 6)),
+                            'area': (('y', 'x'), np.full((ny, nx), 625.)),
+                            'ocean_regions': (('nocean',), [6]),
+                            'region_names': (('nregions',), ['Central Arctic'])},
+                           coords={'y': np.arange(ny), 'x': np.arange(nx), 'nregions': [6]})
+    return ds_region
+
+
+def _make_NSIDC_files(tmpdir, days, product='NSIDC_0051', value=250):
+    files = []
+    for cday in days:
+        raw = np.full(import_data.NSIDC_SHAPE, 0, dtype=np.uint8)
+        raw[0:2, 0:2] = value
+        raw[10, 10] = 251
+        cfile = str(tmpdir.join('nt_'+cday+'_f08_v1.1_n.bin'))
+        _write_NSIDC_binary(cfile, raw, product)
+        files.append(cfile)
+    return files
+
+
+def test_bulk_import_NSIDC(tmpdir):
+    from esio import obs_store
+    files = _make_NSIDC_files(tmpdir, ['19901230', '19901231', '19910101', '19910102', '19910103'])
+    out_dir = str(tmpdir.join('yearly'))
+    rate = obs_store.bulk_import_NSIDC(all_files=files, product='NSIDC_0051', out_dir=out_dir,
+                                       ds_region=_make_region(), n_workers=2, block=2)
+    assert rate > 0
+    ds = obs_store.open_obs(obs_store.year_store_path(out_dir, 1991))
+    assert ds.time.size == 3
+    np.testing.assert_allclose(ds.area.values, 4*625/10**6)
+    np.testing.assert_allclose(ds.extent.values, 5*625/10**6)
+    assert ds.hole_mask.isel(time=2, y=10, x=10).values
+
+    # Importing one year again only replaces the days of that year in the extent table
+    table_store = str(tmpdir.join('extent_table'))
+    obs_store.bulk_import_NSIDC(all_files=files, product='NSIDC_0051', out_dir=out_dir,
+                                ds_region=_make_region(), n_workers=2, block=2, table_store=table_store)
+    files_1991 = _make_NSIDC_files(tmpdir, ['19910101', '19910102', '19910103'], value=125)
+    obs_store.bulk_import_NSIDC(all_files=files_1991, product='NSIDC_0051', out_dir=out_dir,
+                                ds_region=_make_region(), n_workers=2, block=2, table_store=table_store)
+    ds_table = xr.open_zarr(table_store)
+    assert ds_table.time.size == 5
+    np.testing.assert_allclose(ds_table.area.isel(nregions=0).values, [4*625/10**6]*2 + [2*625/10**6]*3)
+
+
+def test_append_NSIDC_days(tmpdir):
+    from esio import obs_store
+    out_dir = str(tmpdir.join('yearly'))
+    files = _make_NSIDC_files(tmpdir, ['20180101', '20180102'], value=125)
+    assert obs_store.append_NSIDC_days(files, 'NSIDC_0051', out_dir, _make_region()) == 2
+    files = files + _make_NSIDC_files(tmpdir, ['20180103'])
+    assert obs_store.append_NSIDC_days(files, 'NSIDC_0051', out_dir, _make_region()) == 1
+    assert obs_store.append_NSIDC_days(files, 'NSIDC_0051', out_dir, _make_region()) == 0
+
+    ds = obs_store.open_obs(obs_store.year_store_path(out_dir, 2018))
+    assert ds.time.size == 3
+    np.testing.assert_allclose(ds.sic.isel(time=-1, x=0, y=0).values, 1)
+    np.testing.assert_allclose(ds.sic.isel(time=0, x=0, y=0).values, 0.5)
+
+
+def test_append_NSIDC_late_day(tmpdir):
+    from esio import obs_store
+    out_dir = str(tmpdir.join('yearly'))
+    table = str(tmpdir.join('table'))
+    files = _make_NSIDC_files(tmpdir, ['20180101', '20180103'])
+    assert obs_store.append_NSIDC_days(files, 'NSIDC_0051', out_dir, _make_region(), table_store=table) == 2
+    files = sorted(files + _make_NSIDC_files(tmpdir, ['20180102'], value=125))
+    assert obs_store.append_NSIDC_days(files, 'NSIDC_0051', out_dir, _make_region(), table_store=table) == 1
+
+    ds = obs_store.open_obs(obs_store.year_store_path(out_dir, 2018))
+    ds_t = obs_store.load_extent_table(table)
+    assert (ds_t.time.values == ds.time.values).all() and ds_t.time.size == 3
+    np.testing.assert_allclose(ds_t.area.sel(nregions=6).values, [4*625/10**6, 2*625/10**6, 4*625/10**6])
+
+
+def test_compact_obs_encoding(tmpdir):
+    from esio import obs_store
+    files = _make_NSIDC_files(tmpdir, ['20180101', '20180102'], value=125)
+    ds = import_data.open_NSIDC_batch(files, product='NSIDC_0051').load()
+    for path in [str(tmpdir.join('obs.nc')), str(tmpdir.join('obs.zarr'))]:
+        obs_store.write_obs(ds, path, product='NSIDC_0051')
+        ds_in = obs_store.open_obs(path)
+        assert 'hole_mask_packed' not in ds_in.variables
+        assert (ds_in.hole_mask.values == ds.hole_mask.values).all()
+        np.testing.assert_allclose(ds_in.sic.values, ds.sic.values, atol=1e-6)
+    ds_raw = xr.open_zarr(str(tmpdir.join('obs.zarr')), decode_cf=False)
+    assert ds_raw.sic.dtype == np.uint8
+    assert ds_raw.hole_mask_packed.shape == (2, 448*304/8)
+
+    # Store to store copies (encoding of the source store is not carried over)
+    obs_store.write_obs(obs_store.open_obs(str(tmpdir.join('obs.zarr'))), str(tmpdir.join('copy.nc')),
+                        product='NSIDC_0051')
+    np.testing.assert_allclose(obs_store.open_obs(str(tmpdir.join('copy.nc'))).sic.values, ds.sic.values, atol=1e-6)
+
+
+def test_sync_timeseries_store(tmpdir):
+    from esio import obs_store
+    files = _make_NSIDC_files(tmpdir, ['20180101', '20180102', '20180103'], value=125)
+    map_store = str(tmpdir.join('NSIDC_0051'))
+    obs_store.write_obs(import_data.open_NSIDC_batch(files, product='NSIDC_0051').chunk({'time': 1}), map_store,
+                        product='NSIDC_0051')
+    ds = obs_store.open_obs(map_store)
+    store = str(tmpdir.join('NSIDC_0051_timeseries'))
+    chunks = {'time': 2, 'y': 112, 'x': 76}
+    assert obs_store.sync_timeseries_store(ds.isel(time=[0]), store, 'NSIDC_0051', chunks=chunks) == 1
+    assert obs_store.sync_timeseries_store(ds, store, 'NSIDC_0051', chunks=chunks) == 2
+    assert obs_store.sync_timeseries_store(ds, store, 'NSIDC_0051', chunks=chunks) == 0
+    ds_ts = obs_store.open_obs(store)
+    assert ds_ts.sic.chunks[1][0] == 112
+    np.testing.assert_allclose(ds_ts.sic.values, ds.sic.values)
+    assert (ds_ts.hole_mask.values == ds.hole_mask.values).all()
+
+
+def test_extent_table(tmpdir):
+    from esio import obs_store
+    (ny, nx) = import_data.NSIDC_SHAPE
+    ds_region = _make_region()
+    mask = np.full((ny, nx), 6)
+    mask[:, 100:] = 7
+    mask[:, 200:] = 21 # land
+    ds_region = ds_region.drop_vars(['region_names', 'nregions'])
+    ds_region['mask'] = (('y', 'x'), mask)
+    ds_region['ocean_regions'] = (('nocean',), [6, 7])
+    ds_region.coords['nregions'] = [6, 7, 21]
+    ds_region['region_names'] = (('nregions',), ['Central Arctic', 'Beaufort Sea', 'land'])
+
+    files = _make_NSIDC_files(tmpdir, ['20180101', '20180102'])
+    out_dir = str(tmpdir.join('yearly'))
+    table = str(tmpdir.join('table'))
+    obs_store.append_NSIDC_days(files[:1], 'NSIDC_0051', out_dir, ds_region, table_store=table)
+    obs_store.append_NSIDC_days(files, 'NSIDC_0051', out_dir, ds_region, table_store=table)
+
+    ds_t = obs_store.load_extent_table(table)
+    assert ds_t.extent.dims == ('time', 'nregions')
+    assert list(ds_t.nregions.values) == [6, 7]
+    np.testing.assert_allclose(ds_t.extent.sel(nregions=6).values, 4*625/10**6)
+    np.testing.assert_allclose(ds_t.extent_hole.sel(nregions=6).values, 5*625/10**6)
+
+    # Same as pan-Arctic calc_extent
+    ds_sic = import_data.open_NSIDC_batch(files, product='NSIDC_0051')
+    pan = obs_store.load_extent_table(table, regions=ds_region.ocean_regions.values, panArctic=True)
+    np.testing.assert_allclose(pan.extent_hole.values,
+                               metrics.calc_extent(ds_sic.sic, ds_region, fill_pole_hole=True).values)
+
+
+def test_file_catalog(tmpdir):
+    from esio import catalog
+    ndir = tmpdir.mkdir('native')
+    for f in ['nt_20180101_f18_nrt_n.bin', 'nt_20180102_f18_nrt_n.bin', 'readme.txt']:
+        ndir.join(f).write('x')
+    cat = catalog.FileCatalog(str(tmpdir.join('cat.sqlite')))
+    new = cat.scan(str(ndir), pattern='*.bin', source='NSIDC_0081', kind='native')
+    assert len(new) == 2
+    assert cat.scan(str(ndir), pattern='*.bin', source='NSIDC_0081', kind='native') == []
+    assert len(cat.files(source='NSIDC_0081', start='2018-01-02')) == 1
+
+    assert len(cat.pending('import', source='NSIDC_0081')) == 2
+    cat.mark(new[0], 'import')
+    assert cat.pending('import', source='NSIDC_0081') == new[1:]
+
+    ndir.join('nt_20180103_f18_nrt_n.bin').write('x')
+    ndir.join('nt_20180102_f18_nrt_n.bin').remove()
+    assert len(cat.scan(str(ndir), pattern='*.bin', source='NSIDC_0081', kind='native')) == 1
+    assert [os.path.basename(x) for x in cat.pending('import')] == ['nt_20180103_f18_nrt_n.bin']
+    assert catalog.guess_file_date('ncep_2018_03.grib') == '2018-03-01'
+
+
+def test_hole_mask_table(tmpdir):
+    from esio import grid_masks, obs_store
+    (ny, nx) = import_data.NSIDC_SHAPE
+    times = np.array(['1985-01-01', '1986-01-01', '2010-01-01'], dtype='datetime64[ns]')
+    hole = np.zeros((3, ny, nx), dtype=bool)
+    hole[0:2, 0:3, 0:3] = True # SMMR has the bigger hole
+    hole[2, 0, 0] = True
+    ds = xr.Dataset({'sic': (('time', 'y', 'x'), np.zeros((3, ny, nx)))},
+                    coords={'time': times, 'hole_mask': (('time', 'y', 'x'), hole)})
+    table = grid_masks.build_hole_mask_table(ds)
+    assert table.hole_mask.shape == (3, ny, nx)
+    assert not table.hole_mask.sel(era='SSMI').any()
+
+    path = str(tmpdir.join('holes.nc'))
+    grid_masks.save_hole_mask_table(table, path)
+    obs_store.write_obs(ds, str(tmpdir.join('obs.zarr')), product='NSIDC_0051', hole_mask=False)
+    ds_in = obs_store.open_obs(str(tmpdir.join('obs.zarr')),
+                               hole_mask_table=grid_masks.load_hole_mask_table(path))
+    assert (ds_in.hole_mask.values == hole).all()
+
+
+def test_surface_masks(tmpdir):
+    from esio import grid_masks, obs_store
+    files = _make_NSIDC_files(tmpdir, ['20180101', '20180102'])
+    raw = np.fromfile(files[0], dtype=np.uint8)
+    raw[300 + 20] = 254 # land on first day
+    raw[300 + 21] = 255 # missing on first day only
+    raw.tofile(files[0])
+    masks = grid_masks.build_surface_masks(files, 'NSIDC_0051')
+    assert masks.land.isel(y=0, x=20).values
+    assert not masks.missing.isel(y=0, x=21).values
+
+    ds = import_data.open_NSIDC_batch(files, product='NSIDC_0051')
+    obs_store.write_obs(ds, str(tmpdir.join('obs.zarr')), product='NSIDC_0051')
+    ds_in = obs_store.open_obs(str(tmpdir.join('obs.zarr')), surface_masks=masks)
+    assert ds_in.land.dims == ('y', 'x')
+
+
+def test_consolidated_obs(tmpdir):
+    from esio import obs_store
+
+    def make(days, value, product):
+        (ny, nx) = import_data.NSIDC_SHAPE
+        times = np.array(days, dtype='datetime64[ns]')
+        return xr.Dataset({'sic': (('time', 'y', 'x'), np.full((len(days), ny, nx), value, dtype=np.float32))},
+                          coords={'time': times, 'hole_mask': (('time', 'y', 'x'), np.zeros((len(days), ny, nx), bool))})
+
+    store = str(tmpdir.join('consolidated'))
+    ds_nrt = make(['2018-01-01', '2018-01-02', '2018-01-04'], 0.5, 'NSIDC_0081')
+    assert obs_store.update_consolidated_obs({'NSIDC_0081': ds_nrt}, store) == 4
+    ds_final = make(['2018-01-01', '2018-01-02'], 0.2, 'NSIDC_0051')
+    ds_nrt = make(['2018-01-01', '2018-01-02', '2018-01-04', '2018-01-05'], 0.5, 'NSIDC_0081')
+    assert obs_store.update_consolidated_obs({'NSIDC_0051': ds_final, 'NSIDC_0081': ds_nrt}, store) == 3
+    assert obs_store.update_consolidated_obs({'NSIDC_0051': ds_final, 'NSIDC_0081': ds_nrt}, store) == 0
+
+    ds = obs_store.open_consolidated_obs(store)
+    assert ds.time.size == 4
+    assert list(ds.source.values) == [0, 0, 1, 1]
+    np.testing.assert_allclose(ds.sic.isel(x=0, y=0).values, [0.2, 0.2, 0.5, 0.5])
+    assert obs_store.open_consolidated_obs(store, drop_missing=False).time.size == 5
+
+    # Inputs covering only part of the stored record, other stored days are left as they are
+    assert obs_store.update_consolidated_obs({'NSIDC_0051': make(['2018-01-03'], 0.3, 'NSIDC_0051')}, store) == 1
+    assert obs_store.update_consolidated_obs({'NSIDC_0051': make(['2018-01-04'], 0.4, 'NSIDC_0051')}, store) == 1
+    ds = obs_store.open_consolidated_obs(store)
+    assert list(ds.source.values) == [0, 0, 0, 0, 1]
+    np.testing.assert_allclose(ds.sic.isel(x=0, y=0).values, [0.2, 0.2, 0.3, 0.4, 0.5])
+
+    # Days between the stored ones and new ones are stored as missing, then filled in later
+    assert obs_store.update_consolidated_obs({'NSIDC_0081': make(['2018-01-08'], 0.8, 'NSIDC_0081')}, store) == 3
+    ds = obs_store.open_consolidated_obs(store, drop_missing=False)
+    assert list(ds.source.values) == [0, 0, 0, 0, 1, -1, -1, 1]
+    assert obs_store.update_consolidated_obs({'NSIDC_0051': make(['2018-01-06', '2018-01-07'], 0.6,
+                                                                  'NSIDC_0051')}, store) == 2
+    ds = obs_store.open_consolidated_obs(store)
+    assert list(ds.source.values) == [0, 0, 0, 0, 1, 0, 0, 1]
+    assert (np.diff(ds.time.values) == np.timedelta64(1, 'D')).all()
+
+
+def test_open_obs_range(tmpdir):
+    from esio import obs_store
+    out_dir = str(tmpdir.join('yearly'))
+    files = _make_NSIDC_files(tmpdir, ['20161231', '20170101', '20171230', '20171231', '20180101', '20180102'])
+    obs_store.append_NSIDC_days(files, 'NSIDC_0051', out_dir, _make_region())
+
+    ds = obs_store.open_obs_range(out_dir, last_days=2)
+    assert [str(x)[:10] for x in ds.time.values] == ['2017-12-31', '2018-01-01', '2018-01-02']
+    ds = obs_store.open_obs_range(out_dir, start='2017-01-01', end='2017-12-30')
+    assert ds.time.size == 2
+    ds = obs_store.open_obs_range(out_dir, start='2018-01-02')
+    assert ds.time.size == 1
+
+
+def _make_grid(ny, nx, lat0=50., lat1=89., lon0=-180., lon1=179.):
+    lat = np.linspace(lat0, lat1, ny)
+    lon = np.linspace(lon0, lon1, nx)
+    (lon2, lat2) = np.meshgrid(lon, lat)
+    return xr.Dataset(coords={'lat': (('nj', 'ni'), lat2), 'lon': (('nj', 'ni'), lon2)})
+
+
+def test_weight_cache(tmpdir, monkeypatch):
+    import scipy.sparse
+    from esio import regrid
+    calls = []
+
+    def builder(ds_in, ds_out, method):
+        calls.append(method)
+        return scipy.sparse.random(ds_out.lat.size, ds_in.lat.size, density=0.01, format='csr')
+
+    ds_in = _make_grid(10, 20)
+    ds_out = _make_grid(5, 6)
+    cache = regrid.WeightCache(str(tmpdir.join('weights')))
+    A = cache.get(ds_in, ds_out, 'bilinear', builder=builder)
+    A2 = cache.get(ds_in, ds_out, 'bilinear', builder=builder)
+    assert len(calls) == 1
+    assert (A != A2).nnz == 0
+
+    # A different source grid or method has its own weights
+    cache.get(_make_grid(10, 21), ds_out, 'bilinear', builder=builder)
+    cache.get(ds_in, ds_out, 'conservative', builder=builder)
+    assert len(calls) == 3
+
+    # Corrupt files are rebuilt
+    path = cache.path(cache.key(ds_in, ds_out, 'bilinear'))
+    with open(path, 'w') as f:
+        f.write('junk')
+    cache.get(ds_in, ds_out, 'bilinear', builder=builder)
+    assert len(calls) == 4
+
+    # A lock left by a dead process is taken over, and removed once built
+    import socket
+    lock = cache.path(cache.key(ds_in, ds_out, 'patch')) + '.lock'
+    with open(lock, 'w') as f:
+        f.write(socket.gethostname() + ':999999999:dead')
+    cache.get(ds_in, ds_out, 'patch', builder=builder)
+    assert len(calls) == 5
+    assert not os.path.exists(lock)
+
+    # A lock of another (live) process is never removed by this one
+    with open(lock, 'w') as f:
+        f.write('otherhost:1:live')
+    assert not cache._lock(lock, regrid._lock_token())
+    cache._unlock(lock, regrid._lock_token())
+    assert os.path.exists(lock)
+    os.remove(lock)
+
+    # Least recently used are evicted, files evicted by another process meanwhile are skipped
+    remove = os.remove
+
+    def remove_twice(f):
+        remove(f)
+        remove(f) # as if another process removed it too
+    monkeypatch.setattr(os, 'remove', remove_twice)
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda d: listdir(d) + ['gone.nc'])
+    cache.max_bytes = os.path.getsize(path)
+    cache.evict(keep=path)
+    monkeypatch.undo()
+    assert os.listdir(str(tmpdir.join('weights'))) == [os.path.basename(path)]
+
+
+def test_sparse_regridder():
+    import scipy.sparse
+    from esio import regrid
+    ds_in = _make_grid(6, 8)
+    ds_out = _make_grid(3, 4)
+    A = scipy.sparse.random(12, 48, density=0.2, format='csr', random_state=0)
+    data = np.random.rand(2, 5, 6, 8)
+    da = xr.DataArray(data, dims=('ensemble', 'fore_time', 'nj', 'ni'),
+                      coords={'lat': ds_in.lat, 'lon': ds_in.lon})
+    regridder = regrid.Regridder(A, ds_out, block_size=3)
+    expected = (A @ data.reshape(10, 48).T).T.reshape(2, 5, 3, 4)
+
+    da_out = regridder(da)
+    assert da_out.dims == ('ensemble', 'fore_time', 'y', 'x')
+    assert da_out.dtype == np.float32
+    np.testing.assert_allclose(da_out.values, expected, rtol=1e-5)
+    da_out = regridder(da.chunk({'ensemble': 1}))
+    assert da_out.chunks is not None
+    np.testing.assert_allclose(da_out.values, expected, rtol=1e-5)
+    assert 'sic' in regridder(da.to_dataset(name='sic'))
+
+
+def test_normalized_weights(tmpdir, monkeypatch):
+    import scipy.sparse
+    from esio import import_data, regrid
+    ds_in = _make_grid(2, 2)
+    ds_out = _make_grid(1, 3)
+    # Target 0 averages all sources, target 1 only the masked source, target 2 is outside
+    A = scipy.sparse.csr_matrix(np.array([[0.25, 0.25, 0.25, 0.25],
+                                          [0., 0., 0., 0.5],
+                                          [0., 0., 0., 0.]]))
+    mask = np.array([[True, True], [True, False]])
+    calls = []
+
+    def builder(ds_in, ds_out, method):
+        calls.append(method)
+        return A
+
+    cache = regrid.WeightCache(str(tmpdir))
+    A_norm = cache.get_normalized(ds_in, ds_out, 'conservative', mask_in=mask, builder=builder)
+    np.testing.assert_allclose(A_norm.toarray()[0], [1/3., 1/3., 1/3., 0])
+    assert regrid.empty_rows(A_norm).tolist() == [False, True, True]
+    cache.get_normalized(ds_in, ds_out, 'conservative', mask_in=mask, builder=builder)
+    cache.get_normalized(ds_in, ds_out, 'conservative', mask_in=~mask, builder=builder)
+    assert len(calls) == 1 # base weights built once, for both masks
+
+    # Cached normalized weights are read without reading the base weights
+    reads = []
+    read_weights = regrid.read_weights
+    monkeypatch.setattr(regrid, 'read_weights', lambda path: reads.append(path) or read_weights(path))
+    cache.get_normalized(ds_in, ds_out, 'conservative', mask_in=mask, builder=builder)
+    assert len(reads) == 1
+    monkeypatch.undo()
+
+    # Regular source grids (1D lat and lon) take a 2D mask too
+    ds_reg = xr.Dataset(coords={'lat': [60., 70.], 'lon': [0., 10.]})
+    A_reg = cache.get_normalized(ds_reg, ds_out, 'conservative', mask_in=mask, builder=builder)
+    assert (A_reg != A_norm).nnz == 0
+
+    da = xr.DataArray(np.array([[[1., 2.], [3., np.nan]]]), dims=('time', 'nj', 'ni'))
+    regridder = regrid.Regridder.from_cache(cache, ds_in.assign(mask=(('nj', 'ni'), mask)), ds_out,
+                                            'conservative', builder=builder)
+    np.testing.assert_allclose(regridder(da).values.ravel(), [2., np.nan, np.nan])
+
+    class Dummy(object):
+        pass
+    r = Dummy()
+    r.A = scipy.sparse.coo_matrix(A)
+    r = import_data.add_matrix_NaNs(r)
+    assert np.isnan(r.A.toarray()[2, 0]) and r.A.nnz == A.nnz + 1
+
+
+def test_nearest_index(tmpdir):
+    from esio import import_data, regrid
+    ds_in = _make_grid(20, 36, lat0=40., lat1=89.5, lon0=-180., lon1=170.)
+    # Across the dateline and near the pole the nearest cell is not the closest in degrees
+    (iy, ix) = import_data.naive_fast(ds_in.lat, ds_in.lon, 60., 178.)
+    assert (ds_in.lat.values[iy, ix], ds_in.lon.values[iy, ix]) == (ds_in.lat.values[iy, 0], -180.)
+    (iy, ix) = import_data.naive_fast(ds_in.lat.values, ds_in.lon.values, np.array([89.9, 40.]), np.array([0., 0.]))
+    assert iy.tolist() == [19, 0]
+
+    # Same answer as brute force great circle distances
+    ds_out = _make_grid(7, 9, lat0=45., lat1=88., lon0=-175., lon1=175.)
+    cache = regrid.WeightCache(str(tmpdir))
+    A = cache.get(ds_in, ds_out, 'nearest_s2d') # KD-tree builder, no xesmf needed
+    xyz_in = regrid.lat_lon_to_xyz(ds_in.lat.values, ds_in.lon.values)
+    xyz_out = regrid.lat_lon_to_xyz(ds_out.lat.values, ds_out.lon.values)
+    cos_dist = xyz_out @ xyz_in.T
+    np.testing.assert_allclose(cos_dist[np.arange(A.shape[0]), A.indices], cos_dist.max(axis=1)) # ties allowed
+    assert (A.sum(axis=1) == 1).all()
+
+
+def test_clean_fields():
+    import scipy.sparse
+    from esio import regrid
+    land = np.array([[False, True], [False, False]])
+    sic = np.array([[[1.2, 0.5], [np.nan, -0.1]]])
+    ds = xr.Dataset({'sic': (('time', 'y', 'x'), sic), 'hi': (('time', 'y', 'x'), sic - 1)})
+    expected_sic = [[1., np.nan], [np.nan, 0.]]
+    expected_hi = [[0.2, np.nan], [np.nan, 0.]]
+
+    ds_out = regrid.clean_fields(ds.chunk({'time': 1}), land_mask=land)
+    assert set(['ensemble', 'init_time', 'fore_time']).issubset(ds_out.sic.dims)
+    np.testing.assert_allclose(ds_out.sic.squeeze().values, expected_sic, rtol=1e-6)
+    np.testing.assert_allclose(ds_out.hi.squeeze().values, expected_hi, rtol=1e-6)
+    ds_out = regrid.clean_fields(ds, rules={'sic': {'fill': 0.}}, land_mask=land, expand=False)
+    np.testing.assert_allclose(ds_out.sic.values[0], [[1.2, np.nan], [0., -0.1]], rtol=1e-6)
+
+    # Fused into the regridder (identity weights)
+    regridder = regrid.Regridder(scipy.sparse.identity(4), _make_grid(2, 2), rules=regrid.SIPN_VAR_RULES,
+                                 land_mask=land)
+    ds_in = ds.rename({'y': 'nj', 'x': 'ni'})
+    np.testing.assert_allclose(regridder(ds_in).sic.values[0], expected_sic, rtol=1e-6)
+    np.testing.assert_allclose(regridder(ds_in).hi.values[0], expected_hi, rtol=1e-6)
+
+
+def test_gfdl_merged_weights(tmpdir):
+    from esio import regrid
+    (nj, ni) = (190, 360)
+    (lon, lat) = np.meshgrid(np.arange(ni) - 179.5, np.linspace(40., 88., nj))
+    (lon_b, lat_b) = np.meshgrid(np.arange(ni + 1) - 180., np.linspace(39.9, 88.1, nj + 1))
+    ds_in = xr.Dataset(coords={'lat': (('nj', 'ni'), lat), 'lon': (('nj', 'ni'), lon),
+                               'lat_b': (('nj_b', 'ni_b'), lat_b), 'lon_b': (('nj_b', 'ni_b'), lon_b),
+                               'nj': np.arange(nj), 'ni': np.arange(ni),
+                               'nj_b': np.arange(nj + 1), 'ni_b': np.arange(ni + 1)})
+    ds_out = _make_grid(10, 12, lat0=45., lat1=87., lon0=-170., lon1=170.)
+    cache = regrid.WeightCache(str(tmpdir))
+    A = cache.get(ds_in, ds_out, 'nearest_s2d', builder=regrid.build_gfdl_weights, split='GFDL')
+    # Sub grid columns map back to the full grid: same as nearest on the unsplit grid
+    assert A.shape == (120, nj*ni)
+    assert (A != regrid.build_nearest_weights(ds_in, ds_out)).nnz == 0
+    assert cache.key(ds_in, ds_out, 'nearest_s2d', split='GFDL') != cache.key(ds_in, ds_out, 'nearest_s2d')
+
+
+def _regrid_setup(model):
+    return {'model': model, 'pid': os.getpid()}
+
+
+def _regrid_file(regridder=None, model=None, in_file=None, out_file=None):
+    if 'bad' in in_file:
+        raise ValueError('bad file')
+    if 'crash' in in_file:
+        os._exit(1)
+    with open(out_file, 'w') as f:
+        f.write(str(regridder['pid']) + ' ' + regridder['model'])
+
+
+def test_run_regrid(tmpdir, monkeypatch):
+    from esio import catalog, regrid
+    tasks = []
+    for model in ['gfdl', 'ukmo']:
+        for i in range(3):
+            in_file = os.path.join(str(tmpdir), model + '_' + ('bad' if i == 1 else '') + str(i) + '.grib')
+            open(in_file, 'w').close()
+            tasks.append({'model': model, 'in_file': in_file, 'out_file': in_file + '.nc'})
+    cat = catalog.FileCatalog(os.path.join(str(tmpdir), 'cat.sqlite'))
+    cat.scan(str(tmpdir), pattern='*.grib')
+
+    results = regrid.run_regrid(tasks, _regrid_file, setup=_regrid_setup, n_workers=2, mem_budget=1e9,
+                                mem_per_task=1e8, catalog=cat)
+    assert len(results) == 6
+    assert sorted(r['status'] for r in results).count('failed') == 2 # Failures do not stop the batch
+    assert all(r['seconds'] >= 0 for r in results)
+    assert [os.path.basename(x) for x in cat.pending('regrid')] == ['gfdl_bad1.grib', 'ukmo_bad1.grib']
+    assert regrid.get_n_workers(tasks, mem_budget=3e8, mem_per_task=1e8, n_workers=8) == 3
+
+    # A task that kills its worker only fails itself, the others are run in a new pool
+    tasks = []
+    for i in range(8):
+        in_file = os.path.join(str(tmpdir), 'gfdl_' + str(i) + ('crash' if i == 2 else '') + '.nc')
+        tasks.append({'model': 'gfdl', 'in_file': in_file, 'out_file': in_file + '.out'})
+    results = regrid.run_regrid(tasks, _regrid_file, setup=_regrid_setup, n_workers=2, mem_budget=1e9,
+                                mem_per_task=1e8)
+    status = {os.path.basename(r['in_file']): r['status'] for r in results}
+    assert len(results) == 8
+    assert [k for k in status if status[k] == 'failed'] == ['gfdl_2crash.nc']
+
+    # A pool that breaks while a task is submitted does not lose that task
+    import concurrent.futures
+    submit = concurrent.futures.ProcessPoolExecutor.submit
+    calls = []
+
+    def broken_submit(pool, *args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise concurrent.futures.process.BrokenProcessPool('broken')
+        return submit(pool, *args, **kwargs)
+    monkeypatch.setattr(concurrent.futures.ProcessPoolExecutor, 'submit', broken_submit)
+    results = regrid.run_regrid(tasks[:4], _regrid_file, setup=_regrid_setup, n_workers=2, mem_budget=1e9,
+                                mem_per_task=1e8)
+    assert sorted(os.path.basename(r['in_file']) for r in results if r['status'] == 'done') == \
+        ['gfdl_0.nc', 'gfdl_1.nc', 'gfdl_3.nc']
+    assert len(results) == 4
+
+
+def _write_grib(path, short_names=('2t', 'ci'), numbers=(0, 1), steps=(24, 48)):
+    import eccodes
+    with open(path, 'wb') as f:
+        for short_name in short_names:
+            for number in numbers:
+                for step in steps:
+                    gid = eccodes.codes_grib_new_from_samples('regular_ll_sfc_grib2')
+                    eccodes.codes_set(gid, 'productDefinitionTemplateNumber', 1)
+                    eccodes.codes_set(gid, 'shortName', short_name)
+                    eccodes.codes_set(gid, 'number', number)
+                    eccodes.codes_set(gid, 'dataDate', 20180101)
+                    eccodes.codes_set(gid, 'stepUnits', 'h')
+                    eccodes.codes_set(gid, 'endStep', step)
+                    values = np.full(eccodes.codes_get(gid, 'numberOfValues'), number + step/100.)
+                    values[0] = 9999 # missing
+                    eccodes.codes_set(gid, 'bitmapPresent', 1)
+                    eccodes.codes_set_values(gid, values)
+                    eccodes.codes_write(gid, f)
+                    eccodes.codes_release(gid)
+
+
+def test_grib_index(tmpdir):
+    pytest.importorskip('eccodes')
+    from esio import grib
+    path = os.path.join(str(tmpdir), 'ecmwf_2018_01.grib')
+    _write_grib(path)
+    index = grib.get_index(path)
+    assert len(index) == 8 and os.path.exists(grib.get_index_path(path))
+    assert (grib.get_index(path).offset == index.offset).all() # From the sidecar
+
+    da = grib.open_grib_var(path)
+    assert da.dims == ('ensemble', 'init_time', 'fore_time', 'lat', 'lon')
+    assert da.chunks is not None and da.attrs['grib_shortName'] == 'ci'
+    values = da.isel(ensemble=1, fore_time=1).values[0]
+    assert np.isnan(values.ravel()[0])
+    np.testing.assert_allclose(values.ravel()[1:], 1.48, rtol=1e-5)
+    assert da.fore_time.values[1] == np.timedelta64(48, 'h')
+    with pytest.raises(ValueError):
+        grib.open_grib_var(path, short_names=['icec'])
+
+
+def test_compressed_target(tmpdir):
+    import scipy.sparse
+    from esio import regrid
+    ds_out = _make_grid(4, 5, lat0=60., lat1=90.)
+    A = scipy.sparse.random(20, 12, density=0.5, format='csr', random_state=1)
+    da = xr.DataArray(np.random.rand(3, 3, 4), dims=('fore_time', 'nj', 'ni'))
+    ds_region = xr.Dataset({'mask': (('y', 'x'), np.tile([6, 6, 20, 6, 6], (4, 1))), 'ocean_regions': ('nocean', [6])})
+    cells = regrid.get_target_cells(ds_out, ds_region=ds_region, lat_min=65.)
+    assert cells.size == 12 # 3 rows north of 65 x 4 ocean columns
+
+    full = regrid.Regridder(A, ds_out)(da)
+    regridder = regrid.Regridder(A, ds_out, cells=cells)
+    assert regridder.A.shape == (12, 12)
+    da_cells = regridder(da.chunk({'fore_time': 1}))
+    assert da_cells.dims == ('fore_time', 'cell')
+    da_2d = regridder.scatter(da_cells.to_dataset(name='sic')).sic
+    assert da_2d.dims == ('fore_time', 'y', 'x')
+    kept = np.zeros(20, dtype=bool)
+    kept[cells] = True
+    kept = kept.reshape(4, 5)
+    np.testing.assert_allclose(da_2d.values[:, kept], full.values[:, kept], rtol=1e-6)
+    assert np.isnan(da_2d.values[:, ~kept]).all()
+
+
+def test_land_fraction_weights(tmpdir, monkeypatch):
+    import scipy.sparse
+    from esio import regrid
+    ds_in = _make_grid(2, 2)
+    ds_out = _make_grid(1, 2)
+    A = scipy.sparse.csr_matrix(np.array([[0.5, 0.5, 0., 0.], [0., 0.5, 0.25, 0.25]]))
+    land = np.array([[0., 0.5], [1., 0.2]])
+    data = np.random.rand(3, 2, 2)
+    # Same as masking the fields before regridding
+    masked = data * (1 - xr.DataArray(land).where(land < 1).values)
+    expected = (A @ masked.reshape(3, 4).T).T
+
+    cache = regrid.WeightCache(str(tmpdir))
+    regridder = regrid.Regridder.from_cache(cache, ds_in, ds_out, 'conservative', builder=lambda *args: A,
+                                            land_frac=land)
+    out = regridder(xr.DataArray(data, dims=('time', 'nj', 'ni'))).values.reshape(3, 2)
+    np.testing.assert_allclose(out, expected, rtol=1e-5)
+    assert np.isnan(out[:, 1]).all()
+    # Dims are matched by name (from ds_in), not by position
+    out_t = regridder(xr.DataArray(data, dims=('time', 'nj', 'ni')).transpose('time', 'ni', 'nj')).values
+    np.testing.assert_allclose(out_t.reshape(3, 2), expected, rtol=1e-5)
+
+    A_renorm = cache.get_land_masked(ds_in, ds_out, 'conservative', land_frac=land, renormalize=True,
+                                     builder=lambda *args: A)
+    np.testing.assert_allclose(A_renorm.toarray()[1], [0., 2/3.*0.5, 0., 1/3.*0.8])
+    assert len([f for f in os.listdir(str(tmpdir)) if f.endswith('.nc')]) == 3 # Base weights shared
+
+    # Regular source grids (1D lat and lon) take a 2D land fraction too
+    ds_reg = xr.Dataset(coords={'lat': [60., 70.], 'lon': [0., 10.]})
+    regridder = regrid.Regridder.from_cache(cache, ds_reg, ds_out, 'conservative', builder=lambda *args: A,
+                                            land_frac=land)
+    out_reg = regridder(xr.DataArray(data, dims=('time', 'lat', 'lon'))).values.reshape(3, 2)
+    np.testing.assert_allclose(out_reg, out, rtol=1e-5)
+
+    # Cached land masked weights are read without reading the base weights
+    reads = []
+    read_weights = regrid.read_weights
+    monkeypatch.setattr(regrid, 'read_weights', lambda path: reads.append(path) or read_weights(path))
+    cache.get_land_masked(ds_in, ds_out, 'conservative', land_frac=land, renormalize=True, builder=lambda *args: A)
+    assert len(reads) == 1
+
+
+def _write_scrip(path, lat_edges, lon_edges):
+    (nj, ni) = (len(lat_edges) - 1, len(lon_edges) - 1)
+    (lon_c, lat_c) = np.meshgrid((lon_edges[:-1] + lon_edges[1:]) / 2, (lat_edges[:-1] + lat_edges[1:]) / 2)
+    corners = []
+    for (dj, di) in [(0, 0), (0, 1), (1, 1), (1, 0)]: # ll, lr, ur, ul (GFDL order)
+        (lon_b, lat_b) = np.meshgrid(lon_edges[di:ni + di], lat_edges[dj:nj + dj])
+        corners.append((lat_b.ravel(), lon_b.ravel()))
+    ds = xr.Dataset({'grid_dims': ('grid_rank', [ni, nj]),
+                     'grid_center_lat': ('grid_size', np.deg2rad(lat_c.ravel())),
+                     'grid_center_lon': ('grid_size', np.deg2rad(lon_c.ravel())),
+                     'grid_imask': ('grid_size', np.ones(nj * ni, dtype=int)),
+                     'grid_corner_lat': (('grid_size', 'grid_corners'), np.deg2rad(np.stack([c[0] for c in corners], 1))),
+                     'grid_corner_lon': (('grid_size', 'grid_corners'), np.deg2rad(np.stack([c[1] for c in corners], 1)))})
+    ds.to_netcdf(path)
+
+
+def test_grid_registry(tmpdir):
+    from esio import grids, import_data
+    grid_file = os.path.join(str(tmpdir), 'gridinfo.nc')
+    lat_edges = np.arange(70., 81., 1.)
+    lon_edges = np.arange(0., 21., 1.)
+    _write_scrip(grid_file, lat_edges, lon_edges)
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+
+    grid = grids.get_grid_info(grid_file, model='GFDL', cache_dir=cache_dir)
+    xr.testing.assert_allclose(grid.drop_vars('area'), import_data.load_grid_info(grid_file, model='GFDL'))
+    band = grids.EARTH_RADIUS**2 * np.deg2rad(1.) * np.abs(np.diff(np.sin(np.deg2rad(lat_edges))))
+    np.testing.assert_allclose(grid.area.values, np.broadcast_to(band[:, None], grid.area.shape), rtol=1e-3)
+
+    grid['lat_b'] = grid.lat_b.where(grid.lat_b < 75, other=75) # Callers changing their copy
+    assert grid.lat_b.max() == 75
+    assert (grids.get_grid_info(grid_file, model='GFDL').lat_b.max() == 80)
+    grids.clear()
+    assert grids.get_grid_info(grid_file, model='GFDL', cache_dir=cache_dir).imask.dtype == bool # From disk
+    assert len(os.listdir(cache_dir)) == 1
+
+    bounds = grids.get_cell_bounds(grid)
+    assert bounds.lat_b.shape == (11, 21)
+    np.testing.assert_allclose(bounds.lat_b.values[:, 0], lat_edges)
+
+
+def test_write_sipn_nc(tmpdir):
+    sic = np.random.rand(2, 3, 5, 6).astype(np.float64)
+    sic[..., 0, 0] = np.nan # land
+    ds = xr.Dataset({'sic': (('ensemble', 'fore_time', 'y', 'x'), sic),
+                     'hi': (('ensemble', 'fore_time', 'y', 'x'), 25 * sic)})
+    for mode in ['float32', 'uint16']:
+        f_out = os.path.join(str(tmpdir), mode + '.nc')
+        if mode == 'uint16': # hi above 20 m is clipped
+            with pytest.warns(UserWarning, match='hi'):
+                import_data.write_sipn_nc(ds, f_out, mode=mode)
+        else:
+            import_data.write_sipn_nc(ds, f_out, mode=mode)
+        with xr.open_dataset(f_out) as ds_in:
+            assert ds_in.sic.dims == ('init_time', 'ensemble', 'fore_time', 'y', 'x')
+            assert ds_in.sic.encoding['dtype'] == np.dtype(mode)
+            assert ds_in.sic.encoding['zlib'] and ds_in.sic.encoding['chunksizes'] == (1, 1, 3, 5, 6)
+            np.testing.assert_allclose(ds_in.sic.values[0], sic, atol=1e-4)
+            assert ds_in.hi.max() <= (20 if mode == 'uint16' else 25)
+            if mode == 'uint16':
+                assert ds_in.hi.attrs['valid_range'].tolist() == [0, 65534]
+                assert ds_in.hi.max() > 19.9 # valid_range is packed, so clipped values are not masked
+
+    # Lazy (dask) inputs are computed once while written
+    import dask.array as dsa
+    calls = []
+
+    def load(block):
+        calls.append(1)
+        return block
+    hi = xr.DataArray(dsa.from_array(25 * sic, chunks=(1, 3, 5, 6)).map_blocks(load),
+                      dims=('ensemble', 'fore_time', 'y', 'x'))
+    del calls[:] # dask calls load on dummy blocks to infer its output
+    with pytest.warns(UserWarning, match='hi'):
+        import_data.write_sipn_nc(xr.Dataset({'hi': hi}), os.path.join(str(tmpdir), 'lazy.nc'), mode='uint16')
+    assert len(calls) == 2
+    with pytest.raises(ValueError):
+        import_data.get_sipn_nc_encoding(ds, mode='float16')